@@ -11,14 +11,27 @@ author: Brennan Klein
 email: brennanjamesklein at gmail dot com
 """
 
+import os
+import multiprocessing
+from collections import OrderedDict
+import json
+import time
+import heapq
+import itertools
 import numpy as np
 import networkx as nx
 from scipy.stats import entropy
 import scipy as sp
 import pandas as pd
 import warnings
+from concurrent.futures import ProcessPoolExecutor
 from sklearn.cluster import OPTICS, cluster_optics_dbscan
 
+# number of candidate merges that each worker process of causal_emergence
+# scores per round trip, so that the cost of the communication is spread
+# over many (cheap) incremental proposals
+CANDIDATE_CHUNK_SIZE = 16
+
 
 def check_network(G):
     """
@@ -27,7 +40,7 @@ def check_network(G):
 
     Parameters
     ----------
-    G (nx.Graph or np.ndarray): the network in question
+    G (nx.Graph, np.ndarray or sp.sparse matrix): the network in question
 
     Returns
     -------
@@ -35,9 +48,15 @@ def check_network(G):
 
     """
 
+    if isinstance(G, MicroNetwork):
+        return G.G
+
     if type(G) == np.ndarray:
         G = nx.from_numpy_array(G, create_using=nx.DiGraph())
 
+    if sp.sparse.issparse(G):
+        G = nx.from_scipy_sparse_array(G, create_using=nx.DiGraph())
+
     if type(G) == nx.classes.graph.Graph:
         G = nx.DiGraph(G)
 
@@ -78,24 +97,177 @@ def check_network(G):
     return G
 
 
-def W_out(G):
+def W_out(G, sparse=None):
     """
     Returns Wout, the transition probability matrix of a graph G, only
     including nodes with outgoing edges.
 
+    The matrix is built directly from the edge list of G (or from the nonzero
+    entries of an array), so the sparse version only ever stores the $M$
+    nonzero transition probabilities instead of a dense $N x N$ array.
+
     Parameters
     ----------
-    G (nx.Graph or np.ndarray): the network in question.
+    G (nx.Graph, np.ndarray or sp.sparse matrix): the network in question.
+    sparse (bool or None): if True, return a scipy CSR matrix. If False,
+            return a dense np.ndarray. If None (default), the output is sparse
+            only when G is itself a scipy sparse matrix.
 
     Returns
     -------
-    Wout (np.ndarray): an $N x N$ transition probability matrix of random
-                       walkers in the system.
+    Wout (np.ndarray or sp.sparse.csr_matrix): an $N x N$ transition
+                       probability matrix of random walkers in the system.
 
     """
 
-    G = check_network(G)
-    return nx.to_numpy_array(G)
+    if sparse is None:
+        sparse = sp.sparse.issparse(G)
+
+    if isinstance(G, MicroNetwork):
+        return G.Wout if sparse else G.Wout.toarray()
+
+    if sp.sparse.issparse(G) or type(G) == np.ndarray:
+        A = sp.sparse.csr_matrix(G, dtype=float, copy=True)
+
+    else:
+        # same convention as check_network: if any edge carries a weight,
+        # the weights are used, otherwise every out-edge counts the same
+        weighted = any('weight' in d for _, _, d in G.edges(data=True))
+        A = nx.to_scipy_sparse_array(G, weight='weight' if weighted else None,
+                                     dtype=float, format='csr')
+        A = sp.sparse.csr_matrix(A)
+
+    A.eliminate_zeros()
+    A.sort_indices()
+
+    # normalize the out-weights of every node with outgoing edges to 1.0
+    out_strength = np.asarray(A.sum(axis=1)).ravel()
+    row_scale = np.zeros(A.shape[0])
+    has_output = out_strength != 0
+    row_scale[has_output] = 1. / out_strength[has_output]
+    A.data *= np.repeat(row_scale, np.diff(A.indptr))
+
+    if sparse:
+        return A
+
+    else:
+        return A.toarray()
+
+
+def _freeze(x):
+    # make the arrays of a cached quantity read-only
+    if sp.sparse.issparse(x):
+        for array in (x.data, x.indices, x.indptr):
+            array.flags.writeable = False
+    elif isinstance(x, np.ndarray):
+        x.flags.writeable = False
+
+    return x
+
+
+class MicroNetwork:
+    """
+    A microscale network compiled once, so that the functions of this module
+    do not have to rebuild the same quantities from a networkx graph on every
+    call. Every function that takes a network accepts a MicroNetwork instead:
+    check_network returns its DiGraph, W_out its transition probability
+    matrix, and stationary_distribution, markov_blanket_pattern and
+    effective_information their cached values.
+
+    Its attributes cannot be reassigned, its graph is frozen (nx.freeze),
+    and each quantity is computed on first use and cached as a read-only
+    array. Edge attributes of the graph can still be edited in place, which
+    the cached quantities would not follow, so work on a copy of G instead.
+
+    Parameters
+    ----------
+    G (nx.Graph, np.ndarray or sp.sparse matrix): the network in question.
+
+    Attributes
+    ----------
+    G (nx.DiGraph): the directed, weighted network given by check_network,
+                    frozen.
+    N (int): the number of nodes.
+    nodes (list): the original label of each node.
+    node_index (dict): the index of each original node label.
+    Wout (sp.sparse.csr_matrix): the transition probability matrix.
+    Wout_T (sp.sparse.csr_matrix): its transpose.
+    has_output (np.ndarray): boolean mask of the nodes with out-edges.
+    has_input (np.ndarray): boolean mask of the nodes with in-edges.
+    in_weights (np.ndarray): the column sums of the transition probability
+                             matrix.
+    stationary (np.ndarray): the stationary distribution.
+    markov_blanket (sp.sparse.csr_matrix): the Markov blanket pattern.
+    EI (float): the effective information of the network.
+
+    """
+
+    def __init__(self, G):
+        object.__setattr__(self, 'G', nx.freeze(check_network(G)))
+        object.__setattr__(self, '_cache', {})
+
+    def __setattr__(self, name, value):
+        raise AttributeError("MicroNetwork is immutable")
+
+    def _cached(self, name, compute):
+        if name not in self._cache:
+            self._cache[name] = _freeze(compute())
+        return self._cache[name]
+
+    @property
+    def N(self):
+        return self.G.number_of_nodes()
+
+    @property
+    def nodes(self):
+        return self._cached('nodes', lambda: [
+            self.G.nodes[i].get('label', i) for i in range(self.N)])
+
+    @property
+    def node_index(self):
+        return self._cached('node_index', lambda: {
+            label: i for i, label in enumerate(self.nodes)})
+
+    @property
+    def Wout(self):
+        return self._cached('Wout', lambda: W_out(self.G, sparse=True))
+
+    @property
+    def Wout_T(self):
+        return self._cached('Wout_T', lambda: self.Wout.T.tocsr())
+
+    @property
+    def has_output(self):
+        return self._cached('has_output', lambda: np.diff(self.Wout.indptr) > 0)
+
+    @property
+    def has_input(self):
+        return self._cached('has_input',
+                            lambda: np.diff(self.Wout_T.indptr) > 0)
+
+    @property
+    def in_weights(self):
+        return self._cached('in_weights', lambda: np.asarray(
+            self.Wout.sum(axis=0)).ravel())
+
+    @property
+    def stationary(self):
+        return self._cached('stationary',
+                            lambda: stationary_distribution(self.Wout))
+
+    @property
+    def markov_blanket(self):
+        return self._cached('markov_blanket',
+                            lambda: markov_blanket_pattern(self.Wout))
+
+    @property
+    def EI(self):
+        return self._cached('EI', lambda: effective_information(self.Wout))
+
+
+def _micro_network(G):
+    # reuse a MicroNetwork that was passed in, or compile one
+    return G if isinstance(G, MicroNetwork) else MicroNetwork(G)
 
 
 def W_in(G, intervention_distribution='Hmax'):
@@ -111,7 +283,7 @@ def W_in(G, intervention_distribution='Hmax'):
 
     Parameters
     ----------
-    G (nx.Graph or np.ndarray): the network in question.
+    G (nx.Graph, np.ndarray or sp.sparse matrix): the network in question.
     intervention_distribution (np.ndarray or str): if 'Hmax', this represents a
             uniform intervention into a system's states. Otherwise, it's a
             heterogeneous intervention, often used in causal emergence (because
@@ -126,7 +298,7 @@ def W_in(G, intervention_distribution='Hmax'):
 
     """
 
-    Wout = W_out(G)
+    Wout = W_out(G, sparse=True)
 
     if str(intervention_distribution) == 'Hmax':
         IntD = np.ones(Wout.shape[0])/Wout.shape[0]
@@ -162,37 +334,33 @@ def effective_information(G):
 
     Parameters
     ----------
-    G (nx.Graph or np.ndarray): the network in question.
+    G (nx.Graph, np.ndarray or sp.sparse matrix): the network in question.
 
     Returns
     -------
     EI (float): the effective information of a given network.
 
     """
+    if isinstance(G, MicroNetwork):
+        return G.EI
+
     # make sure nodes in the network have edge weights that sum to 1.0
-    G = check_network(G)
-    N = G.number_of_nodes()
+    Wout = W_out(G, sparse=True)
 
     # EI is only calculated over nodes with outgoing edges,
     # as sinks don't any information about causation.
-    Nout = len(np.nonzero(list(dict(G.out_degree()).values()))[0])
+    Nout = np.count_nonzero(np.diff(Wout.indptr))
 
     if Nout > 0:
-        # Build empty arrays to fill either with probabilities or entropies
-        Wout = np.zeros(N)
-        Win = np.zeros(N)
-
-        # for each node, calculate its contribution to WOUT and WIN
-        for i, node_i in enumerate(G.nodes()):
-            # get the out-weights of node_i, and add its entropy to WOUT
-            Wout_i = [node_j['weight'] for node_j in G[node_i].values()]
-            Wout[i] = entropy(Wout_i, base=2)
-
-            # add all of its out-weights to the vector of 'in-weights'
-            # (aka the vector of average out-weights), and normalize by
-            # the number of nodes with output, Nout.
-            for j, w_ij in G[node_i].items():
-                Win[j] += w_ij['weight'] / Nout
+        # the entropy of the out-weights of each node, i.e. the "noise" in
+        # its outgoing connections (sinks have an empty row and contribute 0)
+        Wout_entropies = Wout.copy()
+        Wout_entropies.data = -Wout.data * np.log2(Wout.data)
+        Wout_average = Wout_entropies.sum() / Nout
+
+        # the vector of 'in-weights' (aka the vector of average out-weights),
+        # normalized by the number of nodes with output, Nout.
+        Win = np.asarray(Wout.sum(axis=0)).ravel() / Nout
 
         # EI is defined by a subtraction involving two quantities:
         #   1. the average entropy of out-weights in the network,
@@ -203,7 +371,6 @@ def effective_information(G):
         #      represents the maximum possible information you could
         #      get about causation given this network structure.
 
-        Wout_average = np.sum(Wout) / Nout
         Win_entropy = entropy(Win, base=2)
 
         # EI = WIN_entropy - WOUT_average
@@ -214,6 +381,43 @@ def effective_information(G):
         return 0.0
 
 
+def effect_information_all(G, intervention_distribution='Hmax'):
+    """
+    Calculates the effect information of every node in a network at once,
+    i.e. the KL divergence of each node's out-weights from the effect
+    distribution Win, summed directly over the nonzero entries of the sparse
+    transition probability matrix. Under a uniform intervention, the average
+    of these values over the nodes with outputs is the network's EI.
+
+    Parameters
+    ----------
+    G (nx.Graph, np.ndarray or sp.sparse matrix): the network in question.
+    intervention_distribution (np.ndarray or str): if 'Hmax', this represents a
+            uniform intervention into a system's states. Otherwise, it's a
+            heterogeneous intervention, often used in causal emergence (because
+            a coarse-graining can be interpreted as changing the kinds of
+            interventions that are informative about a given system).
+
+    Returns
+    -------
+    EI_i (np.ndarray): the effect information of each node (0 for nodes
+                       without outputs).
+
+    """
+
+    Wout = W_out(G, sparse=True)
+    Win = W_in(Wout, intervention_distribution)
+
+    # every effect of a node is in the support of Win, so the KL divergence
+    # only runs over the node's own out-weights
+    Wout_kld = Wout.copy()
+    with np.errstate(divide='ignore'):
+        Wout_kld.data = Wout.data * (np.log2(Wout.data) -
+                                     np.log2(Win[Wout.indices]))
+
+    return np.asarray(Wout_kld.sum(axis=1)).ravel()
+
+
 def effect_information_i(G, node_i=[], intervention_distribution='Hmax'):
     """
     Calculates the effect information (EI) of a node_i in a network,
@@ -221,7 +425,7 @@ def effect_information_i(G, node_i=[], intervention_distribution='Hmax'):
 
     Parameters
     ----------
-    G (nx.Graph or np.ndarray): the network in question
+    G (nx.Graph, np.ndarray or sp.sparse matrix): the network in question
     node_i (list or int): if node_i = [], this function returns a dictionary of
                     {node_1: EI_1, node_2: EI_2...} but if node_i is specified,
                     it returns the effect information $EI_i$ of node_i.
@@ -242,33 +446,21 @@ def effect_information_i(G, node_i=[], intervention_distribution='Hmax'):
     if type(node_i) != list:
         node_i = [node_i]
 
-    if len(node_i) == 0:
-        node_i = list(G.nodes())
-
-    node_name_mapping = {i: idx for idx, i in enumerate(list(G.nodes()))}
-    node_name_mapping_i = {i: idx for idx, i in node_name_mapping.items()
-                           if idx in node_i}
-
-    EI_i = {i: 0 for i in node_i}
-
-    Wout = W_out(G)
-    Win = W_in(G)
-    nonzeros_in = list(np.nonzero(Win)[0])
+    EI_all = effect_information_all(G, intervention_distribution)
 
-    Wout_i = np.atleast_2d(Wout[list(node_name_mapping_i.keys())])
+    if isinstance(G, nx.Graph):
+        nodes = list(G.nodes())
+    else:
+        nodes = list(range(len(EI_all)))
 
-    for idx, i in enumerate(node_i):
-        nonzeros_out = list(np.nonzero(Wout_i[idx])[0])
-        if len(nonzeros_out) > 0:
-            nonzeros = list(np.unique(nonzeros_in + nonzeros_out))
-            ei_i = entropy(Wout_i[idx][nonzeros], Win[nonzeros], base=2)
-        else:
-            ei_i = 0
+    if len(node_i) == 0:
+        node_i = nodes
 
-        EI_i[i] = ei_i
+    node_index = {i: idx for idx, i in enumerate(nodes)}
+    EI_i = {i: EI_all[node_index[i]] for i in node_i}
 
     if len(node_i) == 1:
-        return ei_i
+        return EI_i[node_i[0]]
 
     else:
         return EI_i
@@ -284,7 +476,7 @@ def determinism(G, intervention_distribution='Hmax'):
 
     Parameters
     ----------
-    G (nx.Graph or np.ndarray): the network in question.
+    G (nx.Graph, np.ndarray or sp.sparse matrix): the network in question.
     intervention_distribution (np.ndarray or str): if 'Hmax', this represents a
             uniform intervention into a system's states. Otherwise, it's a
             heterogeneous intervention, often used in causal emergence (because
@@ -298,12 +490,10 @@ def determinism(G, intervention_distribution='Hmax'):
 
     """
 
-    Wout = W_out(G)
+    Wout = W_out(G, sparse=True)
 
     # Wout_noise is only calculated in nodes that have outputs
-    eligible_nodes = np.nonzero(Wout.sum(axis=1))[0]
-
-    Nout = len(eligible_nodes)
+    Nout = np.count_nonzero(np.diff(Wout.indptr))
 
     if str(intervention_distribution) == 'Hmax':
         IntD = np.ones(Wout.shape[0])/Wout.shape[0]
@@ -313,9 +503,14 @@ def determinism(G, intervention_distribution='Hmax'):
         else:
             return np.zeros(Wout.shape[0])
 
-    if Nout > 0 and sum(sum(Wout)) > 0:
-        det = sum([entropy(Wout_i, IntD, base=2)
-                   for Wout_i in Wout[eligible_nodes]])
+    if Nout > 0 and Wout.sum() > 0:
+        # KL divergence of every out-weight vector from the intervention,
+        # summed directly over the nonzero transition probabilities
+        Wout_kld = Wout.copy()
+        with np.errstate(divide='ignore'):
+            Wout_kld.data = Wout.data * (np.log2(Wout.data) -
+                                         np.log2(IntD[Wout.indices]))
+        det = Wout_kld.sum()
 
         return det / Nout
 
@@ -333,7 +528,7 @@ def degeneracy(G, intervention_distribution='Hmax'):
 
     Parameters
     ----------
-    G (nx.Graph or np.ndarray): the network in question.
+    G (nx.Graph, np.ndarray or sp.sparse matrix): the network in question.
     intervention_distribution (np.ndarray or str): if 'Hmax', this represents
             a uniform intervention into a system's states. Otherwise, it's a
             heterogeneous intervention, often used in causal emergence (because
@@ -346,7 +541,7 @@ def degeneracy(G, intervention_distribution='Hmax'):
 
     """
 
-    Wout = W_out(G)
+    Wout = W_out(G, sparse=True)
 
     if str(intervention_distribution) == 'Hmax':
         IntD = np.ones(Wout.shape[0])/Wout.shape[0]
@@ -356,7 +551,7 @@ def degeneracy(G, intervention_distribution='Hmax'):
         else:
             return np.zeros(Wout.shape[0])
 
-    Win = W_in(G, IntD)
+    Win = W_in(Wout, IntD)
     nodes_with_input = np.nonzero(Win)[0]
 
     if len(nodes_with_input) > 0:
@@ -393,7 +588,80 @@ def effective_information_detdeg(G, intervention_distribution='Hmax'):
     return determinism(G, IntD) - degeneracy(G, IntD)
 
 
-def stationary_distribution(G, smallest=1e-10):
+def effective_information_detdeg_batch(G, intervention_distributions):
+    """
+    Determinism, degeneracy and effective information of a network under many
+    intervention distributions at once. The transition probability matrix is
+    built once and the entropies of every intervention are computed together,
+    giving the same values as determinism, degeneracy and
+    effective_information_detdeg called on each row.
+
+    Parameters
+    ----------
+    G (nx.Graph, np.ndarray or sp.sparse matrix): the network in question.
+    intervention_distributions (np.ndarray): a $B x N$ array with one
+            intervention distribution per row (each row is normalized here).
+
+    Returns
+    -------
+    det (np.ndarray): the determinism under each intervention distribution.
+    deg (np.ndarray): the degeneracy under each intervention distribution.
+    EI (np.ndarray): the effective information, det - deg.
+
+    """
+
+    Wout = W_out(G, sparse=True)
+    Nout = np.count_nonzero(np.diff(Wout.indptr))
+
+    IntD = np.atleast_2d(np.asarray(intervention_distributions, dtype=float))
+    IntD_sum = IntD.sum(axis=1)
+    # as in the single versions, a negative intervention is not normalized
+    # and gets zero determinism and degeneracy
+    valid = IntD_sum >= 0.0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        IntD = IntD / IntD_sum[:, None]
+
+    # determinism: the KL divergence of each out-weight vector from the
+    # intervention is sum_ij W_ij log2 W_ij - sum_j S_j log2 IntD_j, with S_j
+    # the column sums of Wout
+    det = np.zeros(len(IntD))
+    if Nout > 0 and Wout.sum() > 0:
+        plogp = (Wout.data * np.log2(Wout.data)).sum()
+        col_sums = np.asarray(Wout.sum(axis=0)).ravel()
+        with_input = col_sums > 0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            log_IntD = np.log2(IntD[:, with_input])
+        det = (plogp - log_IntD.dot(col_sums[with_input])) / Nout
+
+    # degeneracy: the KL divergence of the effect distribution from the
+    # intervention, both restricted to the intervened nodes
+    with np.errstate(divide='ignore', invalid='ignore'):
+        Win = Wout.T.dot(IntD.T).T
+        Win[~(IntD.sum(axis=1) >= 0.0)] = 0.0
+        Win_sum = Win.sum(axis=1)
+        Win = np.where(Win_sum[:, None] != 0, Win / Win_sum[:, None], 0.0)
+
+        intervened = IntD > 0
+        p = np.where(intervened, Win, 0.0)
+        p_sum = p.sum(axis=1)
+        p = p / p_sum[:, None]
+        q = np.where(intervened, IntD, 0.0)
+        q = q / q.sum(axis=1, keepdims=True)
+        deg = np.where(p > 0, p * np.log2(p / q), 0.0).sum(axis=1)
+
+    # no effects on the intervened nodes leaves the divergence undefined
+    deg[~(p_sum > 0)] = np.nan
+
+    deg[np.count_nonzero(Win, axis=1) == 0] = 0.0
+
+    det = np.where(valid, det, 0.0)
+    deg = np.where(valid, deg, 0.0)
+
+    return det, deg, det - deg
+
+
+def stationary_distribution(G, smallest=1e-10, method='auto', tol=1e-12,
+                            max_iter=100000):
     """
     Return a stationary probability vector of a given network
 
@@ -401,10 +669,28 @@ def stationary_distribution(G, smallest=1e-10):
     x - xA = 0
     x( I - A ) = 0 and sum(x) = 1
 
+    By default this linear system is solved with a dense least-squares
+    solver, which is $O(N^3)$. For large networks it can instead be solved
+    iteratively on the sparse transition probability matrix, either by power
+    iteration of the lazy random walk x <- x (I + A) / 2 (which has the same
+    stationary distribution as A but is aperiodic) or by computing the
+    leading left eigenvector of A with ARPACK. The iterative solvers assume
+    an ergodic chain: on reducible networks, or networks with sinks, the
+    stationary distribution is not unique and they can return a different
+    vector than the least-squares solver.
+
     Parameters
     ----------
-    G (nx.Graph or np.ndarray): the network in question.
+    G (nx.Graph, np.ndarray or sp.sparse matrix): the network in question.
     smallest (float): magnitude of probability that should be set to zero.
+    method (str): one of 'lstsq' (dense least-squares), 'power' (sparse power
+                  iteration) or 'eigs' (sparse eigensolver), the last two
+                  only for ergodic networks. 'auto' (default) is 'lstsq'
+                  whatever the size of the network.
+    tol (float): convergence tolerance of the iterative solvers ('power'
+                 stops when successive vectors differ by less than tol in
+                 L1 norm).
+    max_iter (int): maximum number of iterations of the iterative solvers.
 
     Returns
     -------
@@ -412,13 +698,52 @@ def stationary_distribution(G, smallest=1e-10):
 
     """
 
-    A = W_out(G)
+    if isinstance(G, MicroNetwork) and (smallest, method, tol, max_iter) == \
+            (1e-10, 'auto', 1e-12, 100000):
+        return G.stationary
+
+    A = W_out(G, sparse=True)
     N = A.shape[0]
-    a = np.eye(N) - A
-    a = np.vstack((a.T, np.ones(N)))
-    b = np.matrix([0] * N + [1]).T
 
-    P = np.linalg.lstsq(a, b, smallest)[0]
+    if method == 'auto':
+        method = 'lstsq'
+    if method == 'eigs' and N < 3:
+        # ARPACK needs k < N - 1
+        method = 'lstsq'
+
+    if method == 'lstsq':
+        a = np.eye(N) - A.toarray()
+        a = np.vstack((a.T, np.ones(N)))
+        b = np.matrix([0] * N + [1]).T
+
+        P = np.linalg.lstsq(a, b, smallest)[0]
+
+    elif method == 'power':
+        A_T = A.T.tocsr()
+        P = np.ones(N) / N
+        for _ in range(max_iter):
+            P_next = 0.5 * (P + A_T.dot(P))
+            P_next_sum = P_next.sum()
+            if P_next_sum == 0:
+                P = P_next
+                break
+
+            P_next /= P_next_sum
+            converged = np.abs(P_next - P).sum() < tol
+            P = P_next
+            if converged:
+                break
+
+    elif method == 'eigs':
+        _, vecs = sp.sparse.linalg.eigs(A.T, k=1, which='LR', tol=tol,
+                                        maxiter=max_iter)
+        P = np.real(vecs[:, 0])
+        P = P / P.sum()
+
+    else:
+        raise ValueError("method must be one of 'auto', 'lstsq', 'power' "
+                         "or 'eigs', not %r" % (method,))
+
     P[P < smallest] = 0
 
     if sum(P) != 1.0 and sum(P) != 0:
@@ -427,397 +752,295 @@ def stationary_distribution(G, smallest=1e-10):
     return np.array(P).reshape(N)
 
 
-def random_walker_distribution_t(G, t=1, smallest=1e-10):
+def random_walker_distribution_t(G, t=1, smallest=1e-10, method='matvec'):
     """
     Return a probability vector of a given network after
     $t$ steps of a random walker.
 
+    The walkers start uniformly, take t+1 steps, and the walkers of each
+    starting node are conditioned on not having been absorbed by a sink
+    (i.e. this is W_in of $W^{t+1}$). Instead of forming the matrix power,
+    the surviving mass of every starting node is propagated forward and the
+    conditioned intervention backward through the sparse transition
+    probability matrix, and a whole list of horizons is computed in the same
+    pass.
+
     Parameters
     ----------
-    G (nx.Graph or np.ndarray): the network in question.
+    G (nx.Graph, np.ndarray or sp.sparse matrix): the network in question.
+    t (int or list): the number of steps, or a list of them.
     smallest (float): magnitude of probability that should be set to zero.
+    method (str): 'matvec' (default) takes sparse matrix-vector products, one
+                  per step up to the largest t. 'squaring' builds the powers
+                  $W^{2^k}$ by repeated squaring and combines them, which
+                  takes $log2(t)$ products per horizon and is faster for very
+                  long horizons on small networks.
 
     Returns
     -------
-    P (np.ndarray): vector of stationary probabilities of random walkers.
+    P (np.ndarray): vector of probabilities of random walkers, or an array
+                    with one such vector per row if t is a list.
 
     """
-    G = check_network(G)
-    W = W_out(G)
-    N = W.shape[0]
-    P = W.copy()
-
-    if t == 0:
-        return W_in(W)
 
-    for _ in range(t):
-        P = P.dot(W)
+    Wout = W_out(G, sparse=True)
+    N = Wout.shape[0]
+    steps = np.atleast_1d(t).astype(int) + 1
+
+    def start(survival):
+        # uniform intervention, conditioned on the walkers that survive
+        return np.divide(1.0, survival, out=np.zeros(N), where=survival > 0)
+
+    if method == 'matvec':
+        Wout_T = Wout.T.tocsr()
+
+        # surviving mass of the walkers of each node after every horizon
+        order = np.argsort(steps, kind='stable')
+        survival = np.zeros((N, len(steps)))
+        r = np.ones(N)
+        done = 0
+        for idx in order:
+            for _ in range(steps[idx] - done):
+                r = Wout.dot(r)
+            done = steps[idx]
+            survival[:, idx] = r
+
+        # all horizons are propagated together, each one entering the block
+        # when it has exactly as many steps left as it needs
+        P = np.zeros((N, len(steps)))
+        for k in range(steps.max(), 0, -1):
+            entering = np.nonzero(steps == k)[0]
+            for idx in entering:
+                P[:, idx] = start(survival[:, idx])
+            P = Wout_T.dot(P)
+        P = P.T
+
+    elif method == 'squaring':
+        powers = [Wout]
+
+        def power(k):
+            while k >= len(powers):
+                square = powers[-1].dot(powers[-1])
+                # powers of a connected network soon fill in
+                if sp.sparse.issparse(square) and square.nnz > N * N / 4:
+                    square = square.toarray()
+                powers.append(square)
+            return powers[k]
+
+        P = np.zeros((len(steps), N))
+        for idx, s in enumerate(steps):
+            bits = [k for k in range(int(s).bit_length()) if (s >> k) & 1]
+            r = np.ones(N)
+            for k in bits:
+                r = power(k).dot(r)
+            ps = start(r)
+            for k in bits:
+                ps = power(k).T.dot(ps)
+            P[idx] = ps
 
-    ps = W_in(P)
+    else:
+        raise ValueError("method must be one of 'matvec' or 'squaring', "
+                         "not %r" % (method,))
 
-    if sum(ps) != 1.0 and sum(ps) != 0:
-        ps = ps / sum(ps)
+    P_sum = P.sum(axis=1, keepdims=True)
+    P = np.divide(P, P_sum, out=np.zeros_like(P), where=P_sum != 0)
 
-    ps = np.array(ps).reshape(N)
+    if np.ndim(t) == 0:
+        return P[0]
 
-    return ps
+    return P
 
 
-def create_macro(G, macro_mapping, macro_types={}):
+def create_macro(G, macro_mapping, macro_types={}, sparse=False,
+                 micro_stationary=None):
     r"""
     Coarse-grains a network according to the specified macro_mapping and
     the types of macros that each macro is associated with.
 
+    The macro TPM is computed with a few sparse products. With $P$ the
+    (N x N_macro) membership matrix of micro nodes in macro nodes and $R$ a
+    (N_macro x N) matrix holding, for every macro node, the weights of the
+    micro nodes whose out-weights make up its row (the node itself for micros,
+    the stationary distribution for spatem1/spatem2, the in-weights for
+    spatial macros), the aggregated flows between macro nodes are
+
+        $$ C = R W_{out} P $$
+
+    and each row of C is then normalized according to its macro type.
+
     Parameters
     ----------
-    G (nx.Graph or np.ndarray): the network in question.
+    G (nx.Graph, np.ndarray or sp.sparse matrix): the network in question.
     macro_mapping (dict): a dictionary where the keys are the microscale nodes
              and the values represent the macronode that they are assigned to.
     macro_types (dict): the corresponding macro_types dictionar associated
                     with the type of macronode in the "winning" G_macro.
+    sparse (bool): if True, return the macro TPM as a scipy CSR matrix.
+    micro_stationary (np.ndarray): the stationary distribution of G. If None,
+                    it is computed here, so pass it in when coarse-graining
+                    the same micro network many times.
 
     Returns
     -------
-    M (np.ndarray): coarse-grained network according to the mapping of micro
-                    nodes onto macro nodes, given by macro_mapping.
+    M (np.ndarray or sp.sparse.csr_matrix): coarse-grained network according
+                    to the mapping of micro nodes onto macro nodes, given by
+                    macro_mapping.
 
     """
 
-    G_micro = check_network(G)
-    Wout_micro = W_out(G_micro)
-    # if macro_mapping == {}:
-    #     return Wout_micro
+    Wout_micro = W_out(G, sparse=True)
+    N = Wout_micro.shape[0]
 
     if macro_types == {}:
         macro_types = {j:'spatem1' for i, j in macro_mapping.items() if i != j}
 
-    # the size of the whole microscale network
-    micro_stationary = stationary_distribution(G_micro)
+    # the stationary distribution of the whole microscale network
+    if micro_stationary is None:
+        micro_stationary = stationary_distribution(Wout_micro)
 
     # list of nodes that are in the macroscale network
-    nodes_in_macro_network = list(np.unique(list(macro_mapping.values())))
-
-    # this is the max index of the non-spatem2 macros, every index above this
-    # then will be considered as a spatem2.
-    non_spatem2_max_index = max(nodes_in_macro_network) + 1
-    n_macros_spatem2 = len([i for i, j in macro_types.items()
-                            if j == 'spatem2'])
-    new_max_index_tmp = non_spatem2_max_index+n_macros_spatem2
-    macro_id_spatem2 = list(range(non_spatem2_max_index, new_max_index_tmp))
-
-    # now: these are the indices of the nodes in the TOO_BIG_MACRO
-    nodes_in_macro_network = nodes_in_macro_network + macro_id_spatem2
-    # the size of the TOO_BIG_MACRO that we will be filling in
-    n_TOO_BIG_MACRO = max(nodes_in_macro_network) + 1
-
-    # dictionary where the keys are the indices of the TOO_BIG_MACRO
-    # and the values are the indices of where they will be in the final
-    # matrix returned at the end, M
-    nodes_in_macro_network_mapping = {j: i for i, j in
-                                      enumerate(nodes_in_macro_network)}
-
-    # and make the big empty matrix
-    TOO_BIG_MACRO = np.zeros((n_TOO_BIG_MACRO, n_TOO_BIG_MACRO))
-
-    all_final_node_types = {i: 'micro' for i in nodes_in_macro_network if
-                            i < G_micro.number_of_nodes()}
-
-    for macro_i in nodes_in_macro_network_mapping.keys():
-        if macro_i not in all_final_node_types.keys():
-            all_final_node_types[macro_i] = 'spatem1'
+    labels = np.array([macro_mapping[i] for i in range(N)])
+    nodes_in_macro_network = np.unique(labels)
 
+    # every spatem2 macro comes with an extra mu_mu node, indexed above the
+    # largest macro label in the order in which they appear in macro_types
+    non_spatem2_max_index = nodes_in_macro_network.max() + 1
     macro_mumu_pairings = {}
-    spt2_ind_tmp = 0
-
     for k, v in macro_types.items():
-        all_final_node_types[k] = v
         if v == 'spatem2':
-            mu_mu = macro_id_spatem2[spt2_ind_tmp]
-            all_final_node_types[mu_mu] = 'mu_mu'
-            macro_mumu_pairings[k] = mu_mu
-            spt2_ind_tmp += 1
-
-    # now the goal is to fill in the TOO_BIG_MACRO with the correct values
-    # and, importantly, at the correct indices. do this with a for loop
-
-    for final_node_i in nodes_in_macro_network:
-        # this will be the vector that will be added to the TOO_BIG_MACRO
-        W_i_out_final = np.zeros(n_TOO_BIG_MACRO)
-
-        # we want to check every node for its type:
-        final_node_i_type = all_final_node_types[final_node_i]
-
-        ##########
-        # MICROS #
-        ##########
-        if final_node_i_type == 'micro':
-            # get the indices of the MICRO nodes that this particular micro
-            # node leads to, and the weights associated with those links
-            out_indices = np.nonzero(Wout_micro[final_node_i])[0]
-            out_weights = Wout_micro[final_node_i][out_indices]
-
-            # have a way to convert between the micro nodes it leads to and
-            # the macro index that they will eventually be associated with
-            new_indices = [macro_mapping[i] for i in out_indices]
-
-            for wij_ind, wij in enumerate(out_weights):
-                W_i_out_final[new_indices[wij_ind]] += wij
-
-            TOO_BIG_MACRO[final_node_i, :] = W_i_out_final
-
-        ###########
-        # SPATIAL #
-        ###########
-        if final_node_i_type == 'spatial':
-            micros_in_macro_i = [i for i, m in macro_mapping.items()
-                                 if m == final_node_i]
-            macro_row_sum = np.zeros(Wout_micro.shape[0])
-
-            # get the rows of the Wout_micro associated with the micros
-            # in the macro node that we are currently on
-            Wout_macro_subgraph = Wout_micro[micros_in_macro_i, :]
-
-            # indices of the FINAL macro network that are not in the current
-            # macro. note that "nodes_in_macro_network" is the length of the
-            # size_of_final_macro, and its elements correspond to the *values*
-            # in macro_mapping
-            nodes_outside_macro_i = [i for i in nodes_in_macro_network if
-                                     i not in micros_in_macro_i and
-                                     i != final_node_i]
-
-            # same list as above, but this one uses microscale indices as its
-            # elements so that you can get the right exit rates from Wout_micro
-            nodes_outside_macro_mic_index = [i for i, j in
-                                             macro_mapping.items() if j in
-                                             nodes_outside_macro_i]
-
-            input_probs_to_macro = Wout_micro.T[micros_in_macro_i].T
-
-            # get the input to the nodes in the macro
-            for i in range(len(macro_row_sum)):
-                macro_row_sum += Wout_macro_subgraph.T.dot(
-                                 input_probs_to_macro[i].T)
-
-            if sum(macro_row_sum) == 0:
-                # then there are no inputs from outside
-                W_i_out_final[final_node_i] = 1
-                TOO_BIG_MACRO[final_node_i, :] = W_i_out_final
-
-            # chances are, it's not some huge isolated clique, so we need to
-            # calculate the out-weights of the nodes that make up the macro
+            macro_mumu_pairings[k] = non_spatem2_max_index + \
+                len(macro_mumu_pairings)
 
-            else:
-                # find the indices of micro nodes with input from macro scale
-                out_indices = np.nonzero(
-                                         sum(Wout_micro[micros_in_macro_i])
-                                         [nodes_outside_macro_mic_index])[0]
-
-                # and how do those indices map onto the new indices?
-                new_indices = [nodes_outside_macro_mic_index[i] for
-                               i in out_indices]
-
-                # now, we can fill the row of TOO_BIG_MACRO (corresponding
-                # to the current macro node) with correct edge weight values.
-                for i, wij_ind in enumerate(new_indices):
-                    # old_i   = out_indices[i]
-                    wij_out = macro_mapping[wij_ind]
-                    W_i_out_final[wij_out] += macro_row_sum[wij_ind]
-
-                # and lastly, make a self-loop if there is any.
-                selfloop = sum(macro_row_sum[micros_in_macro_i])
-                if selfloop < 0:
-                    selfloop = 0
-
-                W_i_out_final[final_node_i] = selfloop
-                TOO_BIG_MACRO[final_node_i, :] = W_i_out_final /\
-                    sum(W_i_out_final)
-
-        ###########
-        # SPATEM1 #
-        ###########
-        if final_node_i_type == 'spatem1':
-            # these are the indices of the micros inside this spatem1 macro
-            micros_in_macro_i = [i for i, m in macro_mapping.items()
-                                 if m == final_node_i]
-
-            # get the rows of the Wout_micro associated with those indices
-            Wout_macro_subgraph = Wout_micro[micros_in_macro_i, :]
-
-            # get the stationary dist values of the micro nodes in this macro
-            macro_i_stationary = micro_stationary[micros_in_macro_i]
-
-            # get the total stationary probability inside this macro
-            macro_i_stationary_sum = sum(macro_i_stationary)
-
-            # weight the Wout_macro_subgraph by the stationary distribution
-            Wout_macro_subgraph_weighted = Wout_macro_subgraph.copy()
-            for j, W_j_out in enumerate(Wout_macro_subgraph):
-                Wout_macro_subgraph_weighted[j] = W_j_out*macro_i_stationary[j]
-
-            # get the (FINAL macro net.) indices of nodes not inside this macro
-            nodes_outside_macro_i = [i for i in nodes_in_macro_network if
-                                     i not in micros_in_macro_i and
-                                     i != final_node_i]
-
-            # same list as above but this one uses microscale indices as its
-            # elements so that you can get the right exit rates from Wout_micro
-            nodes_outside_macro_mic_index = [i for i, j in
-                                             macro_mapping.items()
-                                             if j in nodes_outside_macro_i]
-
-            # a len(nodes_outside_macro_mic_index)x1 vector of exitrates
-            Wout_macro_i_exitrates = sum(Wout_macro_subgraph_weighted[:,
-                                         nodes_outside_macro_mic_index])
-
-            # total exit rate probability from the macro in question
-            Wout_macro_i_exitrates_sum = sum(Wout_macro_i_exitrates)
-
-            # if there are no edges w/ weights outside the macro, add selfloop
-            if Wout_macro_i_exitrates_sum == 0:
-                W_i_out_final[final_node_i] = 1
-                TOO_BIG_MACRO[final_node_i, :] = W_i_out_final
-
-            # chances are, it's not some huge isolated clique, so we
-            # calculate the out-weights of the nodes that make up the macro
+    n_macro = len(nodes_in_macro_network)
+    n_final = n_macro + len(macro_mumu_pairings)
+    macro_index = np.searchsorted(nodes_in_macro_network, labels)
 
-            else:
-                # normalize Wout_macro_i_exitrates given macro_i_stationary_sum
-                Wout_macro_i_exitrates_norm = Wout_macro_i_exitrates.copy()
-                for i, wij in enumerate(Wout_macro_i_exitrates):
-                    Wout_macro_i_exitrates_norm[i] = wij/macro_i_stationary_sum
-
-                # micro indices of nodes with inputs from nodes in this macro
-                out_indices = np.nonzero(
-                                sum(Wout_micro[micros_in_macro_i])
-                                [nodes_outside_macro_mic_index])[0]
-
-                # and how do those indices map onto the new indices?
-                new_indices = [nodes_outside_macro_mic_index[i] for
-                               i in out_indices]
-
-                # now, we can fill the row of TOO_BIG_MACRO (corresponding
-                # to the current macro node) with correct edge weight values.
-                for i, wij_ind in enumerate(new_indices):
-                    old_i = out_indices[i]
-                    wij_ind = macro_mapping[wij_ind]
-                    W_i_out_final[wij_ind] += \
-                        Wout_macro_i_exitrates_norm[old_i]
-
-                # and lastly, make a self-loop if there is any.
-                selfloop = 1 - sum(W_i_out_final)
-                if selfloop < 0:
-                    selfloop = 0
-
-                W_i_out_final[final_node_i] = selfloop
-                TOO_BIG_MACRO[final_node_i, :] = W_i_out_final
-
-        ###########
-        # SPATEM2 #
-        ###########
-        if final_node_i_type == 'spatem2':
-            # for the mu_mu node, we need to add another row. This extra
-            # W_i_out_final node will just have a single 1.0 edge weight
-            # to the mu_mu macro node. This bit is primarily for finding
-            # the edge weights from mu_mu.
-            mu_mu_index = macro_mumu_pairings[final_node_i]
-            W_mu_out_final = np.zeros(n_TOO_BIG_MACRO)
-
-            # but first we need to find out which nodes are in the macro
-            micros_in_macro_i = [i for i, m in macro_mapping.items()
-                                 if m == final_node_i]
-
-            # get the rows of the Wout_micro associated with the micros
-            # in the macro node that we are currently on
-            Wout_macro_subgraph = Wout_micro[micros_in_macro_i, :]
-
-            # get the stationary dist values of the micro nodes in this macro
-            macro_i_stationary = micro_stationary[micros_in_macro_i]
-
-            # get the total stationary probability inside this macro
-            macro_i_stationary_sum = sum(macro_i_stationary)
-
-            # weight the Wout_macro_subgraph by the stationary
-            Wout_macro_subgraph_weighted = Wout_macro_subgraph.copy()
-            for j, W_j_out in enumerate(Wout_macro_subgraph):
-                Wout_macro_subgraph_weighted[j] = W_j_out*macro_i_stationary[j]
-
-            # indices of the FINAL macro network that do not include
-            nodes_outside_macro_i = [i for i in nodes_in_macro_network if
-                                     i not in micros_in_macro_i and
-                                     i != final_node_i]
-
-            # same list as above but this uses the microscale indices as its
-            # elements so that you can get the right exit rates from Wout_micro
-            nodes_outside_macro_mic_index = [i for i, j in
-                                             macro_mapping.items()
-                                             if j in nodes_outside_macro_i]
-
-            # a len(nodes_outside_macro_mic_index)x1 vector of exitrates
-            Wout_macro_i_exitrates = sum(
-                Wout_macro_subgraph_weighted[:, nodes_outside_macro_mic_index])
-
-            # total exit rate probability from the macro in question
-            Wout_macro_i_exitrates_sum = sum(Wout_macro_i_exitrates)
-
-            # if there are no edges with weights outside the macro,
-            # then give it a self-loop
-            if Wout_macro_i_exitrates_sum == 0:
-                W_i_out_final[final_node_i] = 1
-                W_mu_out_final[mu_mu_index] = 1
-                TOO_BIG_MACRO[final_node_i, :] = W_i_out_final
-                TOO_BIG_MACRO[mu_mu_index, :] = W_mu_out_final
+    final_node_types = np.where(nodes_in_macro_network < N,
+                                'micro', 'spatem1').astype(object)
+    for k, v in macro_types.items():
+        k_index = np.searchsorted(nodes_in_macro_network, k)
+        if k_index < n_macro and nodes_in_macro_network[k_index] == k:
+            final_node_types[k_index] = v
+
+    # membership matrix P and row-aggregation matrix R
+    P = sp.sparse.csr_matrix((np.ones(N), (np.arange(N), macro_index)),
+                             shape=(N, n_macro))
+
+    micro_weights = np.zeros(N)
+    node_types = final_node_types[macro_index]
+    spatem = (node_types == 'spatem1') | (node_types == 'spatem2')
+    micro_weights[spatem] = micro_stationary[spatem]
+    spatial = node_types == 'spatial'
+    in_weights = np.asarray(Wout_micro.sum(axis=0)).ravel()
+    micro_weights[spatial] = in_weights[spatial]
+
+    R_rows = list(macro_index[spatem | spatial])
+    R_cols = list(np.nonzero(spatem | spatial)[0])
+    R_data = list(micro_weights[spatem | spatial])
+
+    # micro rows are the out-weights of the micro node with that label
+    micro_rows = np.nonzero(final_node_types == 'micro')[0]
+    R_rows += list(micro_rows)
+    R_cols += list(nodes_in_macro_network[micro_rows])
+    R_data += [1.0] * len(micro_rows)
+
+    R = sp.sparse.csr_matrix((R_data, (R_rows, R_cols)), shape=(n_macro, N))
+
+    C = (R.dot(Wout_micro).dot(P)).tocoo()
+    C_row, C_col, C_data = C.row, C.col, C.data
+
+    off_diagonal = C_row != C_col
+    exits_sum = np.bincount(C_row[off_diagonal],
+                            weights=C_data[off_diagonal], minlength=n_macro)
+    row_sum = np.bincount(C_row, weights=C_data, minlength=n_macro)
+
+    macro_stationary = np.bincount(macro_index, weights=micro_stationary,
+                                   minlength=n_macro)
+    mu_mu_index = np.arange(n_macro)
+    for k, mu_mu in macro_mumu_pairings.items():
+        k_index = np.searchsorted(nodes_in_macro_network, k)
+        if k_index < n_macro and nodes_in_macro_network[k_index] == k:
+            mu_mu_index[k_index] = n_macro + (mu_mu - non_spatem2_max_index)
+
+    row_types = final_node_types[C_row]
+    is_micro = row_types == 'micro'
+    is_spatial = row_types == 'spatial'
+    is_spatem1 = row_types == 'spatem1'
+    is_spatem2 = row_types == 'spatem2'
+
+    ##########
+    # MICROS #
+    ##########
+    keep = is_micro.copy()
+    out_rows, out_cols, out_data = [C_row[keep]], [C_col[keep]], [C_data[keep]]
+
+    ###########
+    # SPATIAL #
+    ###########
+    keep = is_spatial & (row_sum[C_row] != 0)
+    out_rows.append(C_row[keep])
+    out_cols.append(C_col[keep])
+    out_data.append(C_data[keep] / row_sum[C_row[keep]])
+
+    ###########
+    # SPATEM1 #
+    ###########
+    keep = is_spatem1 & off_diagonal & (exits_sum[C_row] != 0)
+    out_rows.append(C_row[keep])
+    out_cols.append(C_col[keep])
+    out_data.append(C_data[keep] / macro_stationary[C_row[keep]])
+
+    ###########
+    # SPATEM2 #
+    ###########
+    # the exit rates of a spatem2 macro leave from its mu_mu node instead
+    keep = is_spatem2 & off_diagonal & (exits_sum[C_row] != 0)
+    denom = macro_stationary - exits_sum
+    out_rows.append(mu_mu_index[C_row[keep]])
+    out_cols.append(C_col[keep])
+    out_data.append(C_data[keep] / denom[C_row[keep]])
+
+    # and lastly, the self-loops (and the single edge from a spatem2 macro
+    # to its mu_mu node)
+    macro_i = np.nonzero((final_node_types == 'spatial') & (row_sum == 0))[0]
+    out_rows.append(macro_i)
+    out_cols.append(macro_i)
+    out_data.append(np.ones(len(macro_i)))
+
+    macro_i = np.nonzero(final_node_types == 'spatem1')[0]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        selfloop = np.maximum(1 - exits_sum[macro_i] /
+                              macro_stationary[macro_i], 0)
+    selfloop[exits_sum[macro_i] == 0] = 1.0
+    out_rows.append(macro_i)
+    out_cols.append(macro_i)
+    out_data.append(selfloop)
+
+    macro_i = np.nonzero(final_node_types == 'spatem2')[0]
+    mu_mu = mu_mu_index[macro_i]
+    no_exits = exits_sum[macro_i] == 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mu_selfloop = np.maximum(1 - exits_sum[macro_i] / denom[macro_i], 0)
+    mu_selfloop[no_exits] = 1.0
+    out_rows += [macro_i, mu_mu]
+    out_cols += [np.where(no_exits, macro_i, mu_mu), mu_mu]
+    out_data += [np.ones(len(macro_i)), mu_selfloop]
+
+    M = sp.sparse.csr_matrix((np.concatenate(out_data),
+                              (np.concatenate(out_rows),
+                               np.concatenate(out_cols))),
+                             shape=(n_final, n_final))
+    M.eliminate_zeros()
+
+    if sparse:
+        return M
 
-            else:
-                # normalize Wout_macro_i_exitrates given macro_i_stationary_sum
-                Wout_macro_i_exitrates_norm = Wout_macro_i_exitrates.copy()
-                for i, wij in enumerate(Wout_macro_i_exitrates):
-                    ##########################
-                    # DIFFERENT THAN SPATEM1 #
-                    denom = macro_i_stationary_sum - Wout_macro_i_exitrates_sum
-                    Wout_macro_i_exitrates_norm[i] = wij / denom
-                    ##########################
-
-                # micro indices of nodes with inputs from nodes in this macro
-                out_indices = np.nonzero(
-                                    sum(Wout_micro[micros_in_macro_i])
-                                    [nodes_outside_macro_mic_index])[0]
-
-                # and how do those indices map onto the new indices?
-                new_indices = [nodes_outside_macro_mic_index[i] for
-                               i in out_indices]
-
-                # now, we can fill the row of TOO_BIG_MACRO (corresponding
-                # to the current macro node) with correct edge weight values.
-                for i, wij_ind in enumerate(new_indices):
-                    old_i = out_indices[i]
-                    wij_ind = macro_mapping[wij_ind]
-                    W_mu_out_final[wij_ind] += \
-                        Wout_macro_i_exitrates_norm[old_i]
-
-                # and lastly, make a self-loop if there is any.
-                W_i_out_final[mu_mu_index] = 1
-
-                # do the same check as the spatem1 nodes above
-                mu_selfloop = 1 - sum(W_mu_out_final)
-                if mu_selfloop < 0:
-                    mu_selfloop = 0
-                W_mu_out_final[mu_mu_index] = mu_selfloop
-
-                # add the two vectors to TOO_BIG_MACRO
-                TOO_BIG_MACRO[final_node_i, :] = W_i_out_final
-                TOO_BIG_MACRO[mu_mu_index, :] = W_mu_out_final
-
-        if final_node_i_type == 'mu_mu':
-            # if it's a mu_mu node, it should have already been accounted for,
-            # so skip it during this section of the code, and simply continue.
-            continue
-
-    M = TOO_BIG_MACRO[nodes_in_macro_network, :][:, nodes_in_macro_network]
-
-    return M
-
-
-def select_macro(G_micro, node_i_macro, possible_mapping, macro_types, F=True):
+    else:
+        return M.toarray()
+
+
+def select_macro(G_micro, node_i_macro, possible_mapping, macro_types, F=True,
+                 micro_stationary=None):
     r"""
     Given a current macro_mapping of a micro scale network, and given a new
     node that is being considered for a macro node, this function selects the
@@ -843,6 +1066,8 @@ def select_macro(G_micro, node_i_macro, possible_mapping, macro_types, F=True):
     F (bool): F stands for "fast"--currently this parameter is not in use, but
               when the final version of this codebase is released, if F=False,
               the function will proceed with an exhaustive selection mechanism
+    micro_stationary (np.ndarray): the (cached) stationary distribution of
+                G_micro, passed on to create_macro.
 
     Returns
     -------
@@ -854,9 +1079,9 @@ def select_macro(G_micro, node_i_macro, possible_mapping, macro_types, F=True):
 
     """
 
-    G_micro = check_network(G_micro)
-    # Wout_micro = W_out(G_micro)
-    # micro_stationary = stationary_distribution(G_micro)
+    # the edges are read from the directed graph, while create_macro gets
+    # G_micro as given (e.g. a MicroNetwork, whose TPM is already built)
+    G_edges = check_network(G_micro)
 
     # micronode ids for nodes within the macro
     nodes_in_new_macro = [k for k, v in possible_mapping.items()
@@ -867,10 +1092,10 @@ def select_macro(G_micro, node_i_macro, possible_mapping, macro_types, F=True):
 
     # two dictionaries where the keys are micro nodes in macro and the
     # values are either the nodes that THEY LEAD TO...
-    edges_from_micro_in_macro = {i: list(zip(*list(G_micro.out_edges(i))))[1]
+    edges_from_micro_in_macro = {i: list(zip(*list(G_edges.out_edges(i))))[1]
                                  for i in nodes_in_new_macro}
     # ...or the nodes that LEAD TO THEM...
-    edges_to_micro_in_macro = {i: list(zip(*list(G_micro.in_edges(i))))[0]
+    edges_to_micro_in_macro = {i: list(zip(*list(G_edges.in_edges(i))))[0]
                                for i in nodes_in_new_macro}
 
     # and the nodes inside the macro that are involved with the above dicts...
@@ -894,23 +1119,821 @@ def select_macro(G_micro, node_i_macro, possible_mapping, macro_types, F=True):
            set(nodes_in_macro_with_outside_output))
     # if there is no intersection between the two sets above, make spatem2
     if len(cond) == 0:
-        G_macro = create_macro(G_micro, possible_mapping, macro_types_spatem2)
+        G_macro = create_macro(G_micro, possible_mapping, macro_types_spatem2,
+                               micro_stationary=micro_stationary)
         return G_macro, macro_types_spatem2
 
     #######################
     # For spatiotemporal1 #
     #######################
     else:
-        G_macro = create_macro(G_micro, possible_mapping, macro_types_spatem1)
+        G_macro = create_macro(G_micro, possible_mapping, macro_types_spatem1,
+                               micro_stationary=micro_stationary)
 
         return G_macro, macro_types_spatem1
 
     return G_micro, macro_types
 
 
+class MacroEI:
+    r"""
+    Incremental bookkeeping of the effective information of a spatem1
+    coarse-graining of a micro network, built to score candidate merges in
+    the greedy loop of causal_emergence without rebuilding the macro network.
+
+    The macro TPM is stored row by row. Every row of the macro network is
+    kept as a dictionary of raw out-flows: the out-weights of a micro node,
+    or the stationary-weighted out-weights summed over the members of a
+    macro node (exactly the quantities used by create_macro). From these the
+    engine tracks the normalized rows, their entropies and the column sums
+    $S_j$ of the TPM, so that
+
+        $ EI = log2(Nout) - \frac{1}{Nout} (\sum_j S_j log2 S_j +
+                                             \sum_i H[W_i^{out}]) $
+
+    can be updated by only touching the rows and columns around the nodes
+    that are being moved. A proposed move is staged with propose(), and is
+    then either committed with accept() or discarded with reject(), which
+    leaves the engine exactly in the state it was in before the proposal.
+
+    Parameters
+    ----------
+    G_micro (nx.Graph, np.ndarray or sp.sparse matrix): the micro network.
+    macro_mapping (dict): optional initial mapping of micro nodes (indexed
+                from 0 to N-1, as returned by check_network) onto macro
+                nodes. Defaults to the 1-to-1 mapping.
+    micro_stationary (np.ndarray): optional stationary distribution of the
+                micro network, computed if not provided.
+    tol (float): raw flows smaller than tol (relative to the stationary
+                 probability of their macro node) are treated as zero, which
+                 removes the round-off left over by repeated updates.
+
+    """
+
+    def __init__(self, G_micro, macro_mapping=None, micro_stationary=None,
+                 tol=1e-12):
+
+        self.Wout = W_out(G_micro, sparse=True)
+        self.Wout_T = self.Wout.T.tocsr()
+        self.N = self.Wout.shape[0]
+        self.tol = tol
+
+        if micro_stationary is None:
+            micro_stationary = stationary_distribution(self.Wout)
+        self.micro_stationary = micro_stationary
+
+        if macro_mapping is None:
+            macro_mapping = {i: i for i in range(self.N)}
+        self.labels = np.array([macro_mapping[i] for i in range(self.N)])
+
+        # raw out-flows, total stationary probability and size of each group
+        self.flows = {}
+        self.weight = {}
+        self.size = {}
+        for i in range(self.N):
+            g = self.labels[i]
+            c = self._coefficient(g, i)
+            flows_g = self.flows.setdefault(g, {})
+            self.weight[g] = self.weight.get(g, 0.0) + c
+            self.size[g] = self.size.get(g, 0) + 1
+
+            start, end = self.Wout.indptr[i], self.Wout.indptr[i+1]
+            for j, w_ij in zip(self.Wout.indices[start:end],
+                               self.Wout.data[start:end]):
+                if c * w_ij != 0:
+                    col = self.labels[j]
+                    flows_g[col] = flows_g.get(col, 0.0) + c * w_ij
+
+        # normalized rows, their entropies and the column sums of the TPM
+        self.rows = {}
+        self.entropies = {}
+        self.col_sums = {}
+        for g, flows_g in self.flows.items():
+            row = self._row(g, flows_g, self.weight[g])
+            self.rows[g] = row
+            self.entropies[g] = self._entropy(row)
+            for col, w in row.items():
+                self.col_sums[col] = self.col_sums.get(col, 0.0) + w
+
+        self.Nout = sum(1 for row in self.rows.values() if row)
+        self.row_entropy_sum = sum(self.entropies.values())
+        self.col_sum_plogp = sum(self._plogp(s) for s in self.col_sums.values())
+        self.EI = self._effective_information(
+            self.Nout, self.row_entropy_sum, self.col_sum_plogp)
+
+        self._proposal = None
+
+    def _coefficient(self, g, i):
+        # micro rows enter with weight 1, macro rows with the stationary
+        # probability of the micro node i (as in create_macro's spatem1)
+        if g < self.N:
+            return 1.0
+        return self.micro_stationary[i]
+
+    def _row(self, g, flows_g, weight_g):
+        if g < self.N:
+            total = sum(flows_g.values())
+            if total == 0:
+                return {}
+            return {col: w / total for col, w in flows_g.items()}
+
+        exits = {col: w for col, w in flows_g.items() if col != g}
+        if sum(exits.values()) == 0:
+            return {g: 1.0}
+
+        row = {col: w / weight_g for col, w in exits.items()}
+        selfloop = 1 - sum(row.values())
+        if selfloop > 0:
+            row[g] = selfloop
+
+        total = sum(row.values())
+        return {col: w / total for col, w in row.items()}
+
+    @staticmethod
+    def _plogp(p):
+        if p > 0:
+            return p * np.log2(p)
+        return 0.0
+
+    @staticmethod
+    def _entropy(row):
+        return -sum(w * np.log2(w) for w in row.values() if w > 0)
+
+    @staticmethod
+    def _effective_information(Nout, row_entropy_sum, col_sum_plogp):
+        if Nout > 0:
+            return np.log2(Nout) - (col_sum_plogp + row_entropy_sum) / Nout
+        return 0.0
+
+    def propose(self, moves):
+        r"""
+        Stage the reassignment of some micro nodes to new macro nodes and
+        return the effective information of the resulting macro network.
+
+        Parameters
+        ----------
+        moves (dict): keys are micro nodes and values are the macro node that
+                      they would be assigned to. A micro node can only be
+                      moved back onto its own (micro) label.
+
+        Returns
+        -------
+        EI (float): the effective information of the proposed macro network.
+
+        """
+
+        labels = self.labels
+        moves = {x: b for x, b in moves.items() if labels[x] != b}
+
+        staged_flows = {}
+        staged_weight = {}
+        staged_size = {}
+
+        def flows_of(g):
+            if g not in staged_flows:
+                staged_flows[g] = dict(self.flows.get(g, {}))
+            return staged_flows[g]
+
+        def add(flows_g, col, w):
+            flows_g[col] = flows_g.get(col, 0.0) + w
+
+        # 1. every row pointing at a moved node now points at its new label
+        for x, b in moves.items():
+            a = labels[x]
+            start, end = self.Wout_T.indptr[x], self.Wout_T.indptr[x+1]
+            for r, w_rx in zip(self.Wout_T.indices[start:end],
+                               self.Wout_T.data[start:end]):
+                g = labels[r]
+                cw = self._coefficient(g, r) * w_rx
+                if cw != 0:
+                    flows_g = flows_of(g)
+                    add(flows_g, a, -cw)
+                    add(flows_g, b, cw)
+
+        # 2. the out-flows of each moved node leave its old group and join
+        #    the new one, with their columns already relabeled
+        for x, b in moves.items():
+            a = labels[x]
+            for g in (a, b):
+                if g not in staged_weight:
+                    staged_weight[g] = self.weight.get(g, 0.0)
+                    staged_size[g] = self.size.get(g, 0)
+
+            c_a = self._coefficient(a, x)
+            c_b = self._coefficient(b, x)
+            staged_weight[a] -= c_a
+            staged_size[a] -= 1
+            staged_weight[b] += c_b
+            staged_size[b] += 1
+
+            flows_a = flows_of(a)
+            flows_b = flows_of(b)
+            start, end = self.Wout.indptr[x], self.Wout.indptr[x+1]
+            for j, w_xj in zip(self.Wout.indices[start:end],
+                               self.Wout.data[start:end]):
+                col = moves.get(j, labels[j])
+                if c_a * w_xj != 0:
+                    add(flows_a, col, -c_a * w_xj)
+                if c_b * w_xj != 0:
+                    add(flows_b, col, c_b * w_xj)
+
+        # recompute the rows that changed and their effect on the columns
+        staged_rows = {}
+        staged_entropies = {}
+        staged_col_sums = {}
+        Nout = self.Nout
+        row_entropy_sum = self.row_entropy_sum
+
+        for g, flows_g in staged_flows.items():
+            weight_g = staged_weight.get(g, self.weight.get(g, 0.0))
+            size_g = staged_size.get(g, self.size.get(g, 0))
+
+            if size_g == 0:
+                row = {}
+            else:
+                scale = weight_g if g >= self.N else 1.0
+                for col in [col for col, w in flows_g.items()
+                            if abs(w) <= self.tol * scale]:
+                    del flows_g[col]
+                row = self._row(g, flows_g, weight_g)
+
+            old_row = self.rows.get(g, {})
+            staged_rows[g] = row
+            staged_entropies[g] = self._entropy(row)
+            row_entropy_sum += staged_entropies[g] - self.entropies.get(g, 0)
+            Nout += bool(row) - bool(old_row)
+
+            for col, w in old_row.items():
+                staged_col_sums[col] = staged_col_sums.get(
+                    col, self.col_sums.get(col, 0.0)) - w
+            for col, w in row.items():
+                staged_col_sums[col] = staged_col_sums.get(
+                    col, self.col_sums.get(col, 0.0)) + w
+
+        col_sum_plogp = self.col_sum_plogp
+        for col, s in staged_col_sums.items():
+            if abs(s) <= self.tol:
+                s = staged_col_sums[col] = 0.0
+            col_sum_plogp += self._plogp(s) - \
+                self._plogp(self.col_sums.get(col, 0.0))
+
+        EI = self._effective_information(Nout, row_entropy_sum, col_sum_plogp)
+
+        self._proposal = dict(
+            moves=moves, flows=staged_flows, weight=staged_weight,
+            size=staged_size, rows=staged_rows, entropies=staged_entropies,
+            col_sums=staged_col_sums, Nout=Nout,
+            row_entropy_sum=row_entropy_sum, col_sum_plogp=col_sum_plogp,
+            EI=EI)
+
+        return EI
+
+    def accept(self):
+        """
+        Commit the last proposal, making it the current macro network.
+        """
+
+        proposal = self._proposal
+        self._proposal = None
+
+        for x, b in proposal['moves'].items():
+            self.labels[x] = b
+
+        for g, flows_g in proposal['flows'].items():
+            if proposal['size'].get(g, self.size.get(g, 0)) == 0:
+                for d in (self.flows, self.weight, self.size, self.rows,
+                          self.entropies):
+                    d.pop(g, None)
+                continue
+
+            self.flows[g] = flows_g
+            self.rows[g] = proposal['rows'][g]
+            self.entropies[g] = proposal['entropies'][g]
+
+        for g, size_g in proposal['size'].items():
+            if size_g > 0:
+                self.weight[g] = proposal['weight'][g]
+                self.size[g] = size_g
+
+        for col, s in proposal['col_sums'].items():
+            if s == 0:
+                self.col_sums.pop(col, None)
+            else:
+                self.col_sums[col] = s
+
+        self.Nout = proposal['Nout']
+        self.row_entropy_sum = proposal['row_entropy_sum']
+        self.col_sum_plogp = proposal['col_sum_plogp']
+        self.EI = proposal['EI']
+
+    def reject(self):
+        """
+        Discard the last proposal, leaving the macro network unchanged.
+        """
+
+        self._proposal = None
+
+    def macro_mapping(self):
+        """
+        Returns the current macro_mapping as a dictionary.
+        """
+
+        return {i: int(g) for i, g in enumerate(self.labels)}
+
+    def macro_tpm(self, proposed=False):
+        """
+        Returns the current macro TPM as a CSR matrix whose rows and columns
+        follow the sorted macro labels (the same order as create_macro).
+
+        Parameters
+        ----------
+        proposed (bool): if True, return the TPM of the pending proposal
+                         instead of the committed one.
+
+        Returns
+        -------
+        nodes_in_macro_network (np.ndarray): the sorted macro labels.
+        M (sp.sparse.csr_matrix): the macro scale TPM.
+
+        """
+
+        size = self.size
+        macro_rows = self.rows
+        if proposed and self._proposal is not None:
+            size = {**self.size, **self._proposal['size']}
+            macro_rows = {**self.rows, **self._proposal['rows']}
+
+        nodes_in_macro_network = np.array(sorted(g for g, size_g in
+                                                 size.items() if size_g > 0))
+        index = {g: i for i, g in enumerate(nodes_in_macro_network)}
+
+        rows, cols, data = [], [], []
+        for g, row in macro_rows.items():
+            for col, w in row.items():
+                rows.append(index[g])
+                cols.append(index[col])
+                data.append(w)
+
+        n = len(nodes_in_macro_network)
+        M = sp.sparse.csr_matrix((data, (rows, cols)), shape=(n, n))
+
+        return nodes_in_macro_network, M
+
+
+class Partition:
+    """
+    Array-backed partition of the micro nodes into macro nodes, used by the
+    greedy loop of causal_emergence in place of a macro_mapping dictionary.
+    The label of each node is read from an array, each label keeps the set
+    of its members, and the next free label is tracked as nodes move, so
+    finding a node's macro, listing the members of a macro and allocating a
+    new macro never scan the whole network. Candidate merges are
+    represented as dictionaries of moves (a delta on the partition) and the
+    full mapping is only built when it is needed.
+
+    Parameters
+    ----------
+    macro_mapping (dict or np.ndarray): the label of each micro node, indexed
+                  from 0 to N-1.
+
+    """
+
+    def __init__(self, macro_mapping):
+        N = len(macro_mapping)
+        self.labels = np.array([macro_mapping[i] for i in range(N)],
+                               dtype=np.int64)
+        self.groups = {}
+        for i, g in enumerate(self.labels.tolist()):
+            self.groups.setdefault(g, set()).add(i)
+        self._max_label = max(self.groups) if self.groups else -1
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, x):
+        return int(self.labels[x])
+
+    @property
+    def n_groups(self):
+        return len(self.groups)
+
+    @property
+    def next_label(self):
+        return self._max_label + 1
+
+    def members(self, g):
+        """
+        Returns the sorted list of micro nodes in the macro node g.
+        """
+
+        return sorted(self.groups.get(g, ()))
+
+    def move(self, moves):
+        """
+        Reassigns micro nodes to other (possibly new) macro nodes.
+
+        Parameters
+        ----------
+        moves (dict): keys are micro nodes and values are their new labels.
+
+        """
+
+        for x, b in moves.items():
+            a = int(self.labels[x])
+            if a == b:
+                continue
+
+            self.labels[x] = b
+            self.groups.setdefault(b, set()).add(x)
+            self.groups[a].discard(x)
+            if not self.groups[a]:
+                del self.groups[a]
+
+            if b > self._max_label:
+                self._max_label = b
+            elif a == self._max_label and a not in self.groups:
+                self._max_label = max(self.groups)
+
+    def mapping(self, moves=None):
+        """
+        Returns the partition, with the moves applied if given, as a
+        macro_mapping dictionary.
+        """
+
+        macro_mapping = dict(enumerate(self.labels.tolist()))
+        if moves is not None:
+            macro_mapping.update(moves)
+
+        return macro_mapping
+
+
+def _xlogx(x):
+    # elementwise x log2(x), with 0 log2(0) = 0
+    x = np.asarray(x, dtype=float)
+    return np.where(x > 0, x * np.log2(np.where(x > 0, x, 1.0)), 0.0)
+
+
+def _shared_entries(M, a, candidates):
+    # the entries that row a of the CSR matrix M shares with each of the
+    # rows in candidates: (position of the candidate, value in a, value in
+    # the candidate row)
+    start, end = M.indptr[a], M.indptr[a+1]
+    order = np.argsort(M.indices[start:end])
+    indices_a = M.indices[start:end][order]
+    data_a = M.data[start:end][order]
+
+    B = M[candidates].tocoo()
+    pos = np.searchsorted(indices_a, B.col)
+    pos[pos == len(indices_a)] = 0
+    shared = (len(indices_a) > 0) & (indices_a[pos] == B.col)
+
+    return B.row[shared], data_a[pos[shared]], B.data[shared]
+
+
+def merge_gain_estimates(G, node_i, candidates):
+    r"""
+    A cheap local estimate of the change in effective information caused by
+    merging node_i with each of the candidates into a spatem1 macro node,
+    computed only from the out-weight rows and in-weight columns of the
+    nodes involved, in time proportional to their degrees. Three effects
+    are accounted for: the merged column lowers the entropy of the rows
+    pointing at both nodes, it lowers the entropy of the in-weights $S_j$
+    (more degeneracy), and the two rows are replaced by
+    their stationary-weighted mixture (with its self-loop). The shift of
+    the in-weights caused by the mixture, and any macro nodes already in
+    the network, are ignored, so this is meant to rank candidates, not to
+    replace the exact EI.
+
+    Parameters
+    ----------
+    G (nx.Graph, np.ndarray, sp.sparse matrix or MicroNetwork): the micro
+                network.
+    node_i (int): the node that the candidates would be merged with.
+    candidates (list): the candidate nodes.
+
+    Returns
+    -------
+    gains (np.ndarray): the estimated EI gain of each candidate merge.
+
+    """
+
+    micro = _micro_network(G)
+    candidates = np.asarray(candidates, dtype=int)
+    k = len(candidates)
+    Wout = micro.Wout
+    has_output = micro.has_output
+    S = micro.in_weights
+
+    # 1. in every row r, the columns node_i and b become one column
+    r, x, y = _shared_entries(micro.Wout_T, node_i, candidates)
+    row_entropy_change = -np.bincount(
+        r, weights=_xlogx(x + y) - _xlogx(x) - _xlogx(y), minlength=k)
+
+    # 2. the in-weights of node_i and b are summed
+    S_i, S_b = S[node_i], S[candidates]
+    col_plogp_change = _xlogx(S_i + S_b) - _xlogx(S_i) - _xlogx(S_b)
+
+    # 3. the rows of node_i and b are replaced by their mixture, weighted by
+    #    the stationary distribution, plus a self-loop for the lost mass
+    pi_i, pi_b = micro.stationary[node_i], micro.stationary[candidates]
+    total = pi_i + pi_b
+    p = np.where(total > 0, pi_i / np.where(total > 0, total, 1), 0.5)
+    q = 1 - p
+
+    def entropy_and_mass(rows):
+        B = Wout[rows].copy()
+        B.data = _xlogx(B.data)
+        H = -np.asarray(B.sum(axis=1)).ravel()
+        return H, has_output[rows].astype(float)
+
+    H_i, mass_i = entropy_and_mass([node_i])
+    H_b, mass_b = entropy_and_mass(candidates)
+
+    r, x, y = _shared_entries(Wout, node_i, candidates)
+    overlap = np.bincount(r, weights=_xlogx(p[r] * x + q[r] * y) -
+                          _xlogx(p[r] * x) - _xlogx(q[r] * y), minlength=k)
+    H_mixture = p * H_i - _xlogx(p) * mass_i + q * H_b - _xlogx(q) * mass_b \
+        - overlap - _xlogx(1 - p * mass_i - q * mass_b)
+    row_entropy_change = row_entropy_change + H_mixture - H_i - H_b
+
+    # EI = log2(Nout) - (sum_j S_j log2 S_j + sum_i H[W_i]) / Nout
+    Nout = has_output.sum()
+    plogp_sum = Nout * (np.log2(Nout) - micro.EI) if Nout > 0 else 0.0
+    Nout_macro = Nout - mass_i * mass_b
+    Nout_macro = np.where(Nout_macro > 0, Nout_macro, 1)
+    EI_macro = np.log2(Nout_macro) - (plogp_sum + col_plogp_change +
+                                      row_entropy_change) / Nout_macro
+
+    return EI_macro - micro.EI
+
+
+def _pop_candidate(queue, priority):
+    # pop the next entry of the queue in place: the one with the highest
+    # estimated gain if the queue is a heap, else the last one of the
+    # (shuffled) list
+    if priority:
+        return heapq.heappop(queue)
+    return queue.pop()
+
+
+def _push_candidates(queue, priority, entries):
+    # put entries popped by _pop_candidate back in the queue, so that they
+    # are popped again in the same order
+    if priority:
+        for entry in entries:
+            heapq.heappush(queue, entry)
+    else:
+        queue.extend(reversed(entries))
+
+
+def _shuffle(x, seed, *stream):
+    # shuffle x in place, either with the global numpy random state (if
+    # seed is None) or with its own random stream, identified by the seed
+    # and the integers in stream
+    if seed is None:
+        np.random.shuffle(x)
+    else:
+        np.random.default_rng([seed] + list(stream)).shuffle(x)
+
+
+def _candidate_worker(connection, Wout_micro, micro_stationary,
+                      macro_mapping):
+    # a worker process with its own MacroEI engine. Each request carries the
+    # merges accepted since the worker's previous request, which are
+    # replayed, and a chunk of candidate moves, which are scored in order
+    # until one of them would be accepted (the master never looks further)
+    engine = MacroEI(Wout_micro, macro_mapping=macro_mapping,
+                     micro_stationary=micro_stationary)
+
+    while True:
+        request = connection.recv()
+        if request is None:
+            break
+
+        new_accepted_moves, candidate_moves, EI_current, thresh = request
+        for moves in new_accepted_moves:
+            engine.propose(moves)
+            engine.accept()
+
+        EI_scores = []
+        for moves in candidate_moves:
+            EI_scores.append(engine.propose(moves))
+            if EI_scores[-1] - EI_current > thresh:
+                break
+        engine.reject()
+
+        connection.send(EI_scores)
+
+    connection.close()
+
+
+class _CandidateScorers:
+    # a fixed set of worker processes scoring candidate merges, each with a
+    # pipe of its own so that it is only sent the accepted merges it has not
+    # replayed yet
+
+    def __init__(self, n_workers, Wout_micro, micro_stationary,
+                 macro_mapping):
+        context = multiprocessing.get_context()
+        self.connections = []
+        self.processes = []
+        self.n_synced = []
+        for _ in range(n_workers):
+            connection, child_connection = context.Pipe()
+            process = context.Process(
+                target=_candidate_worker, daemon=True,
+                args=(child_connection, Wout_micro, micro_stationary,
+                      macro_mapping))
+            process.start()
+            child_connection.close()
+            self.connections.append(connection)
+            self.processes.append(process)
+            self.n_synced.append(0)
+
+    def score(self, accepted_moves, candidate_moves, EI_current, thresh):
+        # split the candidates into one contiguous chunk per worker. A
+        # worker stops after the first candidate that passes the threshold,
+        # so the scores of the following candidates of its chunk are None
+        chunks = np.array_split(np.arange(len(candidate_moves)),
+                                len(self.connections))
+        requests = []
+        for w, chunk in enumerate(chunks):
+            if len(chunk) == 0:
+                continue
+            self.connections[w].send((accepted_moves[self.n_synced[w]:],
+                                      [candidate_moves[k] for k in chunk],
+                                      EI_current, thresh))
+            self.n_synced[w] = len(accepted_moves)
+            requests.append((w, chunk))
+
+        EI_scores = [None] * len(candidate_moves)
+        for w, chunk in requests:
+            for k, EI in zip(chunk, self.connections[w].recv()):
+                EI_scores[k] = EI
+
+        return EI_scores
+
+    def close(self):
+        for connection in self.connections:
+            try:
+                connection.send(None)
+            except (OSError, ValueError):
+                pass
+            connection.close()
+        for process in self.processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+
+
+def _save_checkpoint(path, position, micro_nodes_left, labels,
+                     macro_types, MB, EI_current, seed):
+    # the state of the greedy search before visiting micro_nodes_left[position]
+    state = {
+        'position': position,
+        'micro_nodes_left': np.asarray(micro_nodes_left, dtype=np.int64),
+        'mapping': np.asarray(labels, dtype=np.int64),
+        'macro_types_keys': np.array(list(macro_types.keys()), dtype=np.int64),
+        'macro_types_values': np.array(list(macro_types.values()), dtype='U8'),
+        'removed': np.array(sorted(MB.removed), dtype=np.int64),
+        'EI_current': EI_current,
+        'has_seed': seed is not None,
+        'seed': 0 if seed is None else seed,
+    }
+
+    # without a seed, the search draws from the global numpy random state
+    if seed is None:
+        _, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+        state.update(rng_keys=keys, rng_pos=pos, rng_has_gauss=has_gauss,
+                     rng_cached_gaussian=cached_gaussian)
+
+    # write to a temporary file first, so that a job killed while writing
+    # never leaves a truncated checkpoint behind
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez_compressed(f, **state)
+    os.replace(tmp_path, path)
+
+
+def _load_checkpoint(path, N):
+    with np.load(path) as f:
+        state = {k: f[k] for k in f.files}
+
+    if len(state['mapping']) != N:
+        raise ValueError("the checkpoint %r is for a network of %i nodes, "
+                         "not %i" % (path, len(state['mapping']), N))
+
+    has_seed = bool(state['has_seed'])
+    if not has_seed:
+        np.random.set_state(('MT19937', state['rng_keys'],
+                             int(state['rng_pos']),
+                             int(state['rng_has_gauss']),
+                             float(state['rng_cached_gaussian'])))
+
+    return {
+        'position': int(state['position']),
+        'micro_nodes_left': state['micro_nodes_left'].tolist(),
+        'macro_mapping': dict(enumerate(state['mapping'].tolist())),
+        'macro_types': dict(zip(state['macro_types_keys'].tolist(),
+                                state['macro_types_values'].tolist())),
+        'removed': state['removed'].tolist(),
+        'EI_current': float(state['EI_current']),
+        'seed': int(state['seed']) if has_seed else None,
+    }
+
+
+class JSONLinesSink:
+    """
+    A callback for causal_emergence that writes every telemetry event as one
+    line of JSON, so the time spent on a large network can be analysed later
+    (e.g. with pd.read_json(path, lines=True)).
+
+    Parameters
+    ----------
+    path (str): the file the events are appended to.
+    flush (bool): if True, the file is flushed after every event, so that the
+                  progress of a running search can be followed.
+
+    """
+
+    def __init__(self, path, flush=True):
+        self.path = path
+        self.flush = flush
+        self._file = open(path, 'a')
+
+    def __call__(self, event):
+        self._file.write(json.dumps(event) + '\n')
+        if self.flush:
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class _Telemetry:
+    # accumulates the time spent in each phase of the greedy search and
+    # reports it to a callback, once per candidate and once per visited node.
+    # causal_emergence only creates one when a callback is given, and every
+    # timing is guarded by `if telemetry is not None`, so a search without a
+    # callback does no extra work
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.started = time.perf_counter()
+        self.candidate_seconds = {}
+        self.node_seconds = {}
+        self.total_seconds = {}
+        self.n_candidates = 0
+
+    def add(self, phase, started):
+        seconds = time.perf_counter() - started
+        for timings in (self.candidate_seconds, self.node_seconds,
+                        self.total_seconds):
+            timings[phase] = timings.get(phase, 0.0) + seconds
+
+    def emit(self, event, **fields):
+        fields['event'] = event
+        fields['elapsed'] = time.perf_counter() - self.started
+        self.callback(fields)
+
+    def start_node(self):
+        self.node_seconds = {}
+        self.node_candidates = 0
+        self.node_gains = []
+
+    def candidate(self, node_i, possible_macro, queue_length, EI_macro,
+                  EI_current, accepted):
+        self.n_candidates += 1
+        self.node_candidates += 1
+        gain = float(EI_macro - EI_current)
+        if accepted:
+            self.node_gains.append(gain)
+
+        self.emit('candidate', node=int(node_i), candidate=int(possible_macro),
+                  queue_length=int(queue_length), EI_macro=float(EI_macro),
+                  gain=gain, accepted=bool(accepted),
+                  seconds=self.candidate_seconds)
+        self.candidate_seconds = {}
+
+    def end_node(self, node_i, position, queue_length, n_macro):
+        self.emit('node', node=int(node_i), position=int(position),
+                  queue_length=int(queue_length),
+                  candidates=self.node_candidates,
+                  accepted_gains=self.node_gains, n_macro=int(n_macro),
+                  seconds=self.node_seconds)
+
+
 def causal_emergence(G, span=-1, thresh=1e-4, t=500,
                      types=False, check_inacc=False, printt=False,
-                     dev=False):
+                     dev=False, incremental=True, n_jobs=1, seed=None,
+                     checkpoint=None, checkpoint_every=10, resume_from=None,
+                     callback=None, order='random', budget=None):
     r"""
     Given a microscale network, $G$, this function iteratively checks different
     coarse-grainings to see if it finds one with higher effective information.
@@ -920,7 +1943,9 @@ def causal_emergence(G, span=-1, thresh=1e-4, t=500,
     G (nx.Graph or np.ndarray): the network in question.
     span (int): defaults at -1, which means that the entire network will be
                 searched. Positive integers means only a fraction of the
-                possible coarse grains will be searched.
+                possible coarse grains will be searched: a random sample of
+                span nodes, or with order='priority' the span nodes with the
+                most promising candidates.
     thresh (float): if the difference between the micro and macro EI values is
                     greater than this threshold, we will admit the macro node
                     into the coarse-grained network.
@@ -935,6 +1960,44 @@ def causal_emergence(G, span=-1, thresh=1e-4, t=500,
                         accurate macros are added.
     printt (bool): if True, this will print out progress of the algorithm
     dev (bool): default to False, if True it returns more details in a dictionary.
+    incremental (bool): default to True, candidate merges are scored with a
+                        MacroEI engine that only updates the rows and columns
+                        around the merged nodes instead of building the whole
+                        macro network. It is only used when types==False, as
+                        select_macro needs the full macro network.
+    n_jobs (int): number of worker processes that each score a chunk of
+                  candidate merges concurrently (-1 uses all the CPUs). Only
+                  used with the incremental search, otherwise candidates are
+                  scored one at a time.
+    seed (int): if given, the order in which nodes and candidates are visited
+                is drawn from explicit random streams derived from the seed,
+                so the same seed gives the same mapping for any n_jobs. If
+                None, the global numpy random state is used (and, if n_jobs
+                is not 1, a seed is drawn from it).
+    checkpoint (str): if given, the state of the search (mapping, macro
+                      types, nodes already in macros, random state and
+                      position in the list of nodes) is saved to this file,
+                      as a compressed .npz, every checkpoint_every nodes.
+    checkpoint_every (int): number of nodes visited between checkpoints.
+    resume_from (str): a checkpoint file to continue the search from. The
+                       other arguments should be the same as in the run that
+                       wrote it.
+    callback (callable): if given, it is called with a dictionary for every
+                         telemetry event: 'start', one 'candidate' per scored
+                         candidate (queue length, EI_macro, gain, whether it
+                         was accepted), one 'node' per visited node (number
+                         of candidates, accepted EI gains) and 'end'. Each
+                         event has the seconds spent in every phase
+                         (create_macro, select_macro, effective_information,
+                         engine, workers, macro_inaccuracy, check_network)
+                         since the previous event of its kind. For instance,
+                         a JSONLinesSink(path) writes them to a file.
+    order (str): 'random' (default) pops the candidates of each node from a
+                 shuffled queue. 'priority' visits the nodes, and pops their
+                 candidates from a heap, best first, according to the cheap
+                 estimate of merge_gain_estimates.
+    budget (int): if given, at most this many candidates are evaluated for
+                  each visited node.
 
     Returns
     -------
@@ -954,9 +2017,14 @@ def causal_emergence(G, span=-1, thresh=1e-4, t=500,
 
     """
 
-    G_micro = check_network(G)
-    Wout = W_out(G_micro)
-    MB = markov_blanket(G_micro)
+    telemetry = None
+    if callback is not None:
+        telemetry = _Telemetry(callback)
+
+    # everything derived from the micro network is only computed once
+    micro = _micro_network(G)
+    G_micro = micro.G
+    MB = MarkovBlanketIndex(micro)
 
     # will search these nodes. if span is > 1, we will search a sample of the
     # network for good coarse grains, but if it's default (-1), search the
@@ -968,121 +2036,327 @@ def causal_emergence(G, span=-1, thresh=1e-4, t=500,
     # various types of macros associated with a given mapping.
     macro_types = {}
 
-    np.random.shuffle(micro_nodes_left)
-    if span > 1:
-        micro_nodes_left = micro_nodes_left[:span]
-
     # original microscale EI, with uniform intervention
-    EI_micro = effective_information(G_micro)
+    EI_micro = micro.EI
     EI_current = EI_micro
 
+    start_position = 0
+    if resume_from is not None:
+        state = _load_checkpoint(resume_from, len(MB))
+        start_position = state['position']
+        micro_nodes_left = state['micro_nodes_left']
+        macro_mapping = state['macro_mapping']
+        macro_types = state['macro_types']
+        MB.remove(state['removed'])
+        EI_current = state['EI_current']
+        seed = state['seed']
+
+    else:
+        # batches of candidates can only be scored in any order if every
+        # random draw comes from its own stream
+        if seed is None and n_jobs != 1:
+            seed = np.random.randint(2**31)
+
+        if order == 'priority':
+            # nodes whose best candidate looks most promising come first
+            best_gain = {node_i: max(merge_gain_estimates(micro, node_i,
+                                                          MB[node_i]))
+                         if len(MB[node_i]) > 0 else -np.inf
+                         for node_i in micro_nodes_left}
+            micro_nodes_left.sort(key=lambda node_i: -best_gain[node_i])
+        else:
+            _shuffle(micro_nodes_left, seed, 0)
+        if span > 1:
+            micro_nodes_left = micro_nodes_left[:span]
+
+    # the micro network never changes, so its stationary distribution is
+    # computed once and reused by every candidate macro network
+    micro_stationary = micro.stationary
+
+    # spatem1 candidates can be scored incrementally, without create_macro
+    engine = None
+    if incremental and not types:
+        Wout_micro = micro.Wout
+        engine = MacroEI(Wout_micro, macro_mapping=macro_mapping,
+                         micro_stationary=micro_stationary)
+
+    # worker processes keep their own copy of the engine, kept in sync by
+    # replaying the accepted merges, and each score a chunk of candidates
+    n_workers = 1
+    batch_size = 1
+    accepted_moves = []
+    if n_jobs != 1 and engine is not None:
+        n_workers = os.cpu_count() if n_jobs == -1 else n_jobs
+        batch_size = n_workers * CANDIDATE_CHUNK_SIZE
+
+    # the acceptance rule only looks at the last 4 inaccuracies, so only
+    # those are computed for each candidate
+    if check_inacc:
+        horizon_inaccuracy = HorizonInaccuracy(micro, t, horizon=4)
+        horizon_inaccuracy.update(macro_mapping)
+
+    # the mapping is kept as a partition, and candidates as moves on it
+    partition = Partition(macro_mapping)
+
     # initialize the mapping as a 1-to-1 mapping (i.e. all nodes are micro)
-    micros_already_macroed = []
     # inaccurate_macro_pairs = 0
     # accurate_macro_pairs   = 0
 
+    if telemetry is not None:
+        telemetry.emit('start', N=len(MB), EI_micro=float(EI_micro),
+                       n_nodes=len(micro_nodes_left) - start_position,
+                       n_jobs=n_workers, incremental=engine is not None)
+
+    if budget is None:
+        budget = np.inf
+
     if printt:
-        print("Starting with this TPM:\n", np.round(Wout, 4))
+        print("Starting with this TPM:\n", np.round(W_out(G_micro), 4))
         print("\nSearch started ... EI_micro = %.4f" % EI_micro)
         print()
-        curr_count = 0
+        curr_count = start_position
         out_of = len(micro_nodes_left)
 
     # if you want to have a List_of_Mappings
     # List_of_Mappings = []
-    for node_i in micro_nodes_left:
-
-        if printt:
-            print("Checking node %05i (%.1f%% done)..." %
-                  (node_i, 100*(curr_count/out_of)),
-                  "coarse-grained network size = %05i" %
-                  len(np.unique(list(macro_mapping.values()))))
-            curr_count += 1
-
-        macros_to_check = update_markov_blanket(MB, micros_already_macroed)
-        macros_to_check = macros_to_check[node_i]
-
-        if len(macros_to_check) < 1:
-            continue
-
-        # make a queue of nodes that need to be checked
-        queue = macros_to_check.copy()
-
-        # node_i is currently assigned to this macro
-        node_i_macro = macro_mapping[node_i]
-
-        # if not yet assigned to a macro, set to next highest macro index
-        if node_i_macro == node_i:
-            node_i_macro = max(list(macro_mapping.values())) + 1
-
-        # now start a loop of EI comparisons
-        while len(queue) > 0:
-            np.random.shuffle(queue)
-
-            # here's a possible micro_node to attempt to group
-            # with node_i in order to make a new macro node
-            possible_macro = queue.pop()
-
-            # this is the hypothetical mapping that we'll compare to
-            possible_mapping = macro_mapping.copy()
-            possible_mapping[node_i] = node_i_macro
-            possible_mapping[possible_macro] = node_i_macro
-
-            # We want to create a variable, G_macro, a candidate macro network
-            if types:
-                G_macro, macro_types_tmp = select_macro(
-                    G_micro, node_i_macro, possible_mapping, macro_types)
+    scorers = None
+    if n_workers > 1:
+        scorers = _CandidateScorers(n_workers, Wout_micro, micro_stationary,
+                                    macro_mapping)
+
+    # the workers are shut down even if the search fails
+    try:
+        for position in range(start_position, len(micro_nodes_left)):
+            node_i = micro_nodes_left[position]
+
+            if checkpoint is not None and position > start_position and \
+                    (position - start_position) % checkpoint_every == 0:
+                _save_checkpoint(checkpoint, position, micro_nodes_left,
+                                 partition.labels, macro_types, MB, EI_current,
+                                 seed)
+
+            if printt:
+                print("Checking node %05i (%.1f%% done)..." %
+                      (node_i, 100*(curr_count/out_of)),
+                      "coarse-grained network size = %05i" %
+                      partition.n_groups)
+                curr_count += 1
+
+            if telemetry is not None:
+                telemetry.start_node()
+
+            # the Markov blanket of node_i, without nodes already in macros
+            macros_to_check = MB[node_i]
+
+            if len(macros_to_check) < 1:
+                if telemetry is not None:
+                    telemetry.end_node(node_i, position, 0, partition.n_groups)
+                continue
+
+            # make a queue of nodes that need to be checked, shuffled once
+            # and popped from the end, or a heap ordered by their estimated
+            # gains
+            priority = order == 'priority'
+            if priority:
+                queue = list(zip(-merge_gain_estimates(micro, node_i,
+                                                       macros_to_check),
+                                 macros_to_check))
+                heapq.heapify(queue)
             else:
-                macro_types_tmp = macro_types.copy()
-                macro_types_tmp[node_i_macro] = "spatem1"
-                G_macro = create_macro(G_micro, possible_mapping,
-                                       macro_types_tmp)
-
-            G_macro = check_network(G_macro)
-            EI_macro = effective_information(G_macro)
-            if np.isinf(EI_macro):
-                return G_macro
-
-            inacc = np.zeros(t)
-            if check_inacc:
-                inacc = macro_inaccuracy(G_micro, G_macro, possible_mapping,
-                                         macro_types_tmp, t)['inaccuracies']
-
-            if EI_macro - EI_current > thresh and sum(inacc[-4:]) < 1e-3:
-
-                # accurate_macro_pairs  += 1
-                # keep adding nodes in the queue to the current macro
-                # grouping once you get anything with a little extra EI
-                EI_current = EI_macro
-                macro_mapping = possible_mapping
-                macro_types = macro_types_tmp.copy()
-
-                if printt:
-                    print("\tJust found a successful macro grouping ...",
-                          "the EI_current = %.4f" % EI_current)
-
-                # avoid inefficient redundant searches
-                micros_already_macroed.append(node_i)
-                micros_already_macroed.append(possible_macro)
-                micros_already_macroed = list(set(micros_already_macroed))
-
-                nodes_in_macro_i = [k for k, v in macro_mapping.items()
-                                    if v == node_i_macro]
-
-                # plus we have to bring in any nodes that node_j might have
-                # that would be relevant
-                for new_micro_i in nodes_in_macro_i:
-                    children_i_M = list(G_micro.successors(new_micro_i))
-                    parents_i_M = list(G_micro.predecessors(new_micro_i))
-                    neighbors_i_M = set(children_i_M).union(set(parents_i_M))
-
-                    for node_j_M in neighbors_i_M:
-                        if node_j_M not in queue and node_j_M != node_i:
-                            queue.append(node_j_M)
+                queue = macros_to_check.copy()
+                _shuffle(queue, seed, 1, node_i)
+
+            # node_i is currently assigned to this macro
+            node_i_macro = partition[node_i]
+
+            # if not yet assigned to a macro, set to next highest macro index
+            if node_i_macro == node_i:
+                node_i_macro = partition.next_label
+
+            # now start a loop of EI comparisons
+            pop_count = 0
+            while len(queue) > 0 and pop_count < budget:
+                # pop the next batch of candidates as if they were all going
+                # to be rejected; the ones after an accepted candidate are
+                # pushed back
+                popped = []
+                while len(popped) < batch_size and len(queue) > 0 and \
+                        pop_count + len(popped) < budget:
+                    popped.append(_pop_candidate(queue, priority))
+                candidates = [entry[1] for entry in popped] if priority \
+                    else popped
+
+                candidate_moves = [{node_i: node_i_macro, c: node_i_macro}
+                                   for c in candidates]
+
+                EI_scores = [None] * len(candidates)
+                if scorers is not None:
+                    if telemetry is not None:
+                        started = time.perf_counter()
+                    EI_scores = scorers.score(accepted_moves, candidate_moves,
+                                              EI_current, thresh)
+                    if telemetry is not None:
+                        telemetry.add('workers', started)
+
+                for k, possible_macro in enumerate(candidates):
+                    # here's a possible micro_node to attempt to group
+                    # with node_i in order to make a new macro node
+                    pop_count += 1
+
+                    # this is the hypothetical mapping that we'll compare to,
+                    # only built when a full mapping is needed
+                    possible_mapping = None
+
+                    # We want to create a variable, G_macro, a candidate macro
+                    # network
+                    if engine is not None:
+                        # stage the candidate in the engine, unless a worker
+                        # already found that it does not increase the EI
+                        EI_macro = EI_scores[k]
+                        if EI_macro is None or EI_macro - EI_current > thresh:
+                            if telemetry is not None:
+                                started = time.perf_counter()
+                            EI_macro = engine.propose(candidate_moves[k])
+                            if check_inacc:
+                                G_macro = engine.macro_tpm(proposed=True)[1]
+                            if telemetry is not None:
+                                telemetry.add('engine', started)
+
+                    else:
+                        if telemetry is not None:
+                            started = time.perf_counter()
+                        possible_mapping = partition.mapping(
+                            candidate_moves[k])
+                        if types:
+                            G_macro, macro_types_tmp = select_macro(
+                                micro, node_i_macro, possible_mapping,
+                                macro_types, micro_stationary=micro_stationary)
+                            if telemetry is not None:
+                                telemetry.add('select_macro', started)
+                        else:
+                            macro_types_tmp = macro_types.copy()
+                            macro_types_tmp[node_i_macro] = "spatem1"
+                            G_macro = create_macro(
+                                micro, possible_mapping, macro_types_tmp,
+                                micro_stationary=micro_stationary)
+                            if telemetry is not None:
+                                telemetry.add('create_macro', started)
+
+                        # the EI is read straight from the macro TPM, without
+                        # building a networkx graph for every candidate
+                        if telemetry is not None:
+                            started = time.perf_counter()
+                        EI_macro = effective_information(G_macro)
+                        if telemetry is not None:
+                            telemetry.add('effective_information', started)
+                        if np.isinf(EI_macro):
+                            return check_network(G_macro)
+
+                    # the inaccuracy is only needed if the EI increased enough
+                    inacc = np.zeros(4)
+                    if check_inacc and EI_macro - EI_current > thresh:
+                        if telemetry is not None:
+                            started = time.perf_counter()
+                        if possible_mapping is None:
+                            possible_mapping = partition.mapping(
+                                candidate_moves[k])
+                        inacc = horizon_inaccuracy.inaccuracies(
+                            possible_mapping, G_macro)
+                        if telemetry is not None:
+                            telemetry.add('macro_inaccuracy', started)
+
+                    accepted = EI_macro - EI_current > thresh and \
+                        sum(inacc[-4:]) < 1e-3
+                    if telemetry is not None:
+                        telemetry.candidate(node_i, possible_macro,
+                                            len(queue) + len(popped) - k - 1,
+                                            EI_macro, EI_current, accepted)
+
+                    if accepted:
+
+                        # accurate_macro_pairs  += 1
+                        # keep adding nodes in the queue to the current macro
+                        # grouping once you get anything with a little extra EI
+                        EI_current = EI_macro
+                        partition.move(candidate_moves[k])
+                        if engine is not None:
+                            macro_types[node_i_macro] = "spatem1"
+                            engine.accept()
+                            accepted_moves.append(candidate_moves[k])
+                        else:
+                            macro_types = macro_types_tmp.copy()
+                        if check_inacc:
+                            horizon_inaccuracy.update(partition.mapping())
+
+                        if printt:
+                            print("\tJust found a successful macro grouping "
+                                  "...", "the EI_current = %.4f" % EI_current)
+
+                        # avoid inefficient redundant searches
+                        MB.remove([node_i, possible_macro])
+
+                        nodes_in_macro_i = partition.members(node_i_macro)
+
+                        # the rest of the batch was scored against the previous
+                        # mapping, so it goes back in the queue to be scored
+                        # again
+                        _push_candidates(queue, priority, popped[k + 1:])
+
+                        # plus we have to bring in any nodes that node_j might
+                        # have that would be relevant
+                        queued = ({c for _, c in queue} if priority
+                                  else set(queue))
+                        new_candidates = []
+                        for new_micro_i in nodes_in_macro_i:
+                            children_i_M = list(
+                                G_micro.successors(new_micro_i))
+                            parents_i_M = list(
+                                G_micro.predecessors(new_micro_i))
+                            neighbors_i_M = set(children_i_M).union(
+                                set(parents_i_M))
+
+                            for node_j_M in neighbors_i_M:
+                                if node_j_M not in queued and \
+                                        node_j_M != node_i:
+                                    new_candidates.append(node_j_M)
+                                    queued.add(node_j_M)
+
+                        if priority and new_candidates:
+                            gains = merge_gain_estimates(micro, node_i,
+                                                         new_candidates)
+                            for gain, node_j_M in zip(gains, new_candidates):
+                                heapq.heappush(queue, (-gain, node_j_M))
+                        elif new_candidates:
+                            queue.extend(new_candidates)
+                            _shuffle(queue, seed, 1, node_i, pop_count)
+
+                        break
+
+                    elif engine is not None:
+                        engine.reject()
+
+            if telemetry is not None:
+                telemetry.end_node(node_i, position, len(queue),
+                                   partition.n_groups)
+
+    finally:
+        if scorers is not None:
+            scorers.close()
+
+    macro_mapping = partition.mapping()
 
     CE = {}
-    G_macro = create_macro(G_micro, macro_mapping, macro_types)
+    if telemetry is not None:
+        telemetry.start_node()
+        started = time.perf_counter()
+    G_macro = create_macro(micro, macro_mapping, macro_types,
+                           micro_stationary=micro_stationary)
+    if telemetry is not None:
+        telemetry.add('create_macro', started)
+        started = time.perf_counter()
     G_macro = check_network(G_macro)
+    if telemetry is not None:
+        telemetry.add('check_network', started)
     EI_macro = effective_information(G_macro)
     if macro_types == {}:
         EI_macro = EI_micro
@@ -1093,16 +2367,27 @@ def causal_emergence(G, span=-1, thresh=1e-4, t=500,
                                     dict(zip(list(G_macro.nodes()),
                                              macro_labels)))
     CE['G_macro'] = G_macro_out
-    CE['G_micro'] = G_micro
+    CE['G_micro'] = G_micro.copy()
     CE['mapping'] = macro_mapping
     CE['macro_types'] = macro_types
     CE['EI_micro'] = EI_micro
     CE['EI_macro'] = EI_macro
 
     if check_inacc:
-        inaccuracies = macro_inaccuracy(G_micro, G_macro, macro_mapping,
+        if telemetry is not None:
+            started = time.perf_counter()
+        inaccuracies = macro_inaccuracy(micro, G_macro, macro_mapping,
                                         macro_types, t)
         CE['inaccuracy'] = inaccuracies['inaccuracies']
+        if telemetry is not None:
+            telemetry.add('macro_inaccuracy', started)
+
+    if telemetry is not None:
+        telemetry.emit('end', EI_macro=float(EI_macro),
+                       n_macro=len(macro_labels),
+                       candidates=telemetry.n_candidates,
+                       final_seconds=telemetry.node_seconds,
+                       seconds=telemetry.total_seconds)
 
     if dev:
         return CE
@@ -1114,7 +2399,30 @@ def causal_emergence(G, span=-1, thresh=1e-4, t=500,
         return mapping_df, wel
 
 
-def macro_inaccuracy(G_micro, G_macro, macro_mapping, macro_types, t=500):
+def _KLD_for_inaccuracy(distr1, distr2):
+    # this can be negative
+    # because the distributions aren't normalized
+    # so normalize before sending them in
+    p = np.asarray(distr1)
+    q = np.asarray(distr2)
+
+    both = (p > 0) & (q > 0)
+    if np.any((p != 0) & (q == 0)):
+        return np.inf
+
+    return np.sum(p[both] * np.log2(p[both] / q[both]))
+
+
+def _effect_distribution_just_micro(Win_j, indices):
+    # the effect distribution over the remaining micro nodes, with the
+    # rest of the probability mass appended at the end
+    ED = Win_j / sum(Win_j)
+    ED_just_micro = ED[indices]
+    return np.append(ED_just_micro, 1 - sum(ED_just_micro))
+
+
+def macro_inaccuracy(G_micro, G_macro, macro_mapping, macro_types, t=500,
+                     sparse=True, return_matrices=False):
     r"""
     Here, we consider only the inaccuracy associated with a macro scale mapping
     through the introduction of random walkers on micronodes that have not been
@@ -1123,6 +2431,10 @@ def macro_inaccuracy(G_micro, G_macro, macro_mapping, macro_types, t=500):
     of random walkers following an intervention distribution on the micro and
     macro representation of the network.
 
+    The distributions of random walkers are propagated one step at a time
+    ($Win_{t+1} = W_{out}^T Win_t$), so only two vectors per scale are kept in
+    memory instead of the $t$ powers of both transition probability matrices.
+
     Parameters
     ----------
     G_micro (nx.Graph or np.ndarray): the micro network in question.
@@ -1135,16 +2447,22 @@ def macro_inaccuracy(G_micro, G_macro, macro_mapping, macro_types, t=500):
     t (int): timesteps in the future (default is t+1, but if more Win indicates
              likely positions of random walkers at t = t+x steps in the future)
              (must be between 1 and T)
+    sparse (bool): if True (default), propagate the distributions with sparse
+                   matrix-vector products, otherwise with dense ones.
+    return_matrices (bool): if True, also return the lists of the $t$ powers
+                   of the micro and macro TPMs and the effect distributions
+                   at every timestep. This needs $O(t N^2)$ memory.
 
     Returns
     -------
-    inaccuracy_dict (dict): dictionary with tensors of TPMs for micro_out,
-                    macro_out, micro_in, micro_out, and a list of inaccuracies.
+    inaccuracy_dict (dict): dictionary with a list of inaccuracies and, if
+                    return_matrices=True, tensors of TPMs for micro_out and
+                    macro_out and the effect distributions over micro nodes.
     """
 
     inaccuracy_dict = {}
-    Wout_micro = W_out(G_micro)
-    Wout_macro = W_out(G_macro)
+    Wout_micro = W_out(G_micro, sparse=sparse)
+    Wout_macro = W_out(G_macro, sparse=sparse)
 
     # get a list of the macro nodes
     nodes_in_micro_network = np.unique(list(macro_mapping.keys()))
@@ -1158,124 +2476,282 @@ def macro_inaccuracy(G_micro, G_macro, macro_mapping, macro_types, t=500):
 
     # get the total amount of macro nodes once HOMs are added in
     # (assuming there are in fact higher-order macros)
-    # N_macro = len(macro_nodes)
-    spatem2_count = 0
-    for x in range(len(macro_nodes)):
-        macro_type = macro_types[macro_nodes[x]]
-        if macro_type == "spatem2":
-            spatem2_count = spatem2_count + 1
+    spatem2_count = len([macro_i for macro_i in macro_nodes
+                         if macro_types[macro_i] == "spatem2"])
 
     # the remaining micro nodes in the macroscale network, after coarsening
     remaining_micro_nodes = nodes_in_macro_network[
                             nodes_in_macro_network < N_micro]
 
     # distribution over micro nodes at microscale
-    distribution_over_micro = np.zeros(N_micro)
-    for x in range(N_micro):
-        for y in range(len(remaining_micro_nodes)):
-            if nodes_in_micro_network[x] == remaining_micro_nodes[y]:
-                distribution_over_micro[x] = 1
+    distribution_over_micro = np.isin(nodes_in_micro_network,
+                                      remaining_micro_nodes).astype(float)
 
+    # the remaining micro nodes are the first nodes at the macroscale
     distribution_over_macro = np.zeros(
                 len(nodes_in_macro_network) + spatem2_count)
+    distribution_over_macro[:len(remaining_micro_nodes)] = 1
+
+    micro_indices = remaining_micro_nodes
+    macro_indices = np.arange(len(remaining_micro_nodes))
+
+    # propagate the distribution over micro nodes at t = ti steps in the
+    # future, at both scales, and compare them at each step
+    Wout_micro_T = Wout_micro.T
+    Wout_macro_T = Wout_macro.T
+    Win_micro = distribution_over_micro
+    Win_macro = distribution_over_macro
 
-    for y in range(len(remaining_micro_nodes)):
-        distribution_over_macro[y] = 1
-
-    # pre-populate a list of transition probability matrices for the micro
-    # at t = ti steps in the future.
-    list_of_micros = [Wout_micro]
-    Wout_micro_t = Wout_micro.copy()
-    for ti in range(1, t):
-        Wout_micro_t = Wout_micro_t.dot(Wout_micro)  # transitions over 1 step
-        list_of_micros.append(Wout_micro_t)
-
-    # pre-populate a list of transition probability matrices for the macro
-    # at t = ti steps in the future.
-    list_of_macros = [Wout_macro]
-    Wout_macro_t = Wout_macro.copy()
-    for ti in range(1, t):
-        Wout_macro_t = Wout_macro_t.dot(Wout_macro)  # transitions over 1 step
-        list_of_macros.append(Wout_macro_t)
-
-    inaccuracy_dict['Wout_micro_list'] = list_of_micros
-    inaccuracy_dict['Wout_macro_list'] = list_of_macros
-
-    # multiply by the distribution_over_micro
+    inaccuracies = np.zeros(t)
     list_of_just_micros = []
-    for micro in list_of_micros:
-        Win_j = micro.T.dot(distribution_over_micro)
-        ED_micro = Win_j / sum(Win_j)
+    list_of_just_micros_macro = []
+    for ti in range(t):
+        Win_micro = Wout_micro_T.dot(Win_micro)
+        Win_macro = Wout_macro_T.dot(Win_macro)
 
-        # get only the micro nodes that are not involved in the macro
-        ED_micro_just_micro = []
-        for x in range(len(ED_micro)):
-            for y in remaining_micro_nodes:
-                if x == y:
-                    ED_micro_just_micro.append(ED_micro[x])
+        ED_micro_just_micro = _effect_distribution_just_micro(
+            Win_micro, micro_indices)
+        ED_macro_just_micro = _effect_distribution_just_micro(
+            Win_macro, macro_indices)
 
-        # append to the end of ED_micro_just_micro the 1-sum
-        ED_micro_just_micro.append(1-sum(ED_micro_just_micro))
+        inaccuracies[ti] = _KLD_for_inaccuracy(ED_macro_just_micro,
+                                               ED_micro_just_micro)
 
-        # add to list
-        list_of_just_micros.append(ED_micro_just_micro)
+        if return_matrices:
+            list_of_just_micros.append(list(ED_micro_just_micro))
+            list_of_just_micros_macro.append(list(ED_macro_just_micro))
 
-    # multiply by the distribution_over_macro
-    list_of_just_micros_macro = []
-    for macro in list_of_macros:
-        Win_j = macro.T.dot(distribution_over_macro)
-        ED_macro = Win_j / sum(Win_j)
-        # EffectDist_macro = ED_macro
-
-        # get only the initial micro nodes (all in front)
-        ED_micro_just_micro = []
-        for y in range(len(remaining_micro_nodes)):
-            ED_micro_just_micro.append(ED_macro[y])
-
-        # append to the end of ED_micro_just_micro the 1-sum
-        ED_micro_just_micro.append(1-sum(ED_micro_just_micro))
-
-        # add to list
-        list_of_just_micros_macro.append(ED_micro_just_micro)
-
-    inaccuracy_dict['EffectDist_micro_just_micro'] = list_of_just_micros
-    inaccuracy_dict['EffectDist_macro_just_micro'] = list_of_just_micros_macro
-
-    def KLD_for_inaccuracy(distr1, distr2):
-        # this can be negative
-        # because the distributions aren't normalized
-        # so normalize before sending them in
-
-        import math
-        total_difference = 0
-
-        for x in range(len(distr1)):
-            difference = 0
-            p = distr1[x]
-            q = distr2[x]
-
-            if p > 0 and q > 0:  # if p != 0 and q !=0:
-                difference = p * math.log((p/q), 2)
-            if p != 0 and q == 0:
-                difference = math.inf
-
-            total_difference = total_difference + difference
-        return total_difference
-
-    # now calculate the final inaccuracies
-    inaccuracies = []
-    for i in range(len(list_of_just_micros_macro)):
-        distr1 = list_of_just_micros_macro[i]
-        distr2 = list_of_just_micros[i]
-        inaccuracy = KLD_for_inaccuracy(distr1, distr2)
-        inaccuracies.append(inaccuracy)
+    if return_matrices:
+        # the t powers of the transition probability matrices
+        for key, Wout in (('Wout_micro_list', Wout_micro),
+                          ('Wout_macro_list', Wout_macro)):
+            if sp.sparse.issparse(Wout):
+                Wout = Wout.toarray()
+
+            list_of_Wouts = [Wout]
+            Wout_t = Wout.copy()
+            for ti in range(1, t):
+                Wout_t = Wout_t.dot(Wout)  # transitions over 1 step
+                list_of_Wouts.append(Wout_t)
+
+            inaccuracy_dict[key] = list_of_Wouts
+
+        inaccuracy_dict['EffectDist_micro_just_micro'] = list_of_just_micros
+        inaccuracy_dict['EffectDist_macro_just_micro'] = \
+            list_of_just_micros_macro
 
     inaccuracies[inaccuracies < 1e-8] = 0
-    inaccuracy_dict['inaccuracies'] = np.array(inaccuracies)
+    inaccuracy_dict['inaccuracies'] = inaccuracies
 
     return inaccuracy_dict
 
 
+def _propagate_tail(Wout_T, Win, t, horizon, tol):
+    # propagate Win for t steps and return its values at the last `horizon`
+    # steps, stopping as soon as it no longer changes (it then stays put)
+    first = t - horizon + 1
+    tail = np.zeros((horizon, len(Win)))
+
+    for ti in range(1, t + 1):
+        Win_next = Wout_T.dot(Win)
+        converged = np.abs(Win_next - Win).sum() <= tol * np.abs(Win).sum()
+        Win = Win_next
+
+        if ti >= first:
+            tail[ti - first] = Win
+        if converged:
+            tail[max(ti, first) - first:] = Win
+            return tail, True
+
+    return tail, False
+
+
+class HorizonInaccuracy:
+    r"""
+    Evaluates only the last few steps of the inaccuracy computed by
+    macro_inaccuracy, which is all that the acceptance rule of
+    causal_emergence(check_inacc=True) looks at.
+
+    Both random walker distributions are propagated one step at a time, and
+    the propagation stops early as soon as a distribution has converged, as
+    the remaining steps are then all equal to it. On the micro scale, the
+    initial distribution is the indicator of the micro nodes that are not in
+    any macro node, so by linearity its trajectory is
+
+        $ (W_{out}^T)^k 1 - \sum_{x \in macros} (W_{out}^T)^k e_x $
+
+    The all-ones trajectory, the trajectory of each micro node that has been
+    tried in a macro and their sum over the accepted macro nodes are cached
+    across candidates, so that in the greedy loop only the macro-side
+    distribution has to be propagated for each candidate.
+
+    Parameters
+    ----------
+    G_micro (nx.Graph, np.ndarray or sp.sparse matrix): the micro network.
+    t (int): the timestep of the last inaccuracy, as in macro_inaccuracy.
+    horizon (int): how many of the last timesteps to evaluate.
+    tol (float): relative L1 change below which a distribution is considered
+                 to have converged.
+    cache_size (int): at most this many single-node trajectories that did
+                      not converge to the limit are cached (the least
+                      recently used are recomputed when needed again), so
+                      the cache takes O(cache_size horizon N) memory.
+
+    """
+
+    def __init__(self, G_micro, t=500, horizon=4, tol=1e-12, cache_size=256):
+
+        self.Wout_T = W_out(G_micro, sparse=True).T.tocsr()
+        self.N = self.Wout_T.shape[0]
+        self.t = t
+        self.horizon = min(horizon, t)
+        self.tol = tol
+
+        self.ones_tail, _ = _propagate_tail(
+            self.Wout_T, np.ones(self.N), t, self.horizon, tol)
+
+        # single-node trajectories that converged to the (normalized)
+        # limit of the all-ones trajectory are only remembered as such, the
+        # others are kept in a least-recently-used cache
+        self.limit = None
+        if np.allclose(self.ones_tail, self.ones_tail[-1], rtol=0,
+                       atol=tol) and self.ones_tail[-1].sum() > 0:
+            self.limit = self.ones_tail[-1] / self.ones_tail[-1].sum()
+        self.at_limit = set()
+        self.cache_size = cache_size
+        self.node_tails = OrderedDict()
+
+        self.merged = set()
+        self.merged_tail = np.zeros((self.horizon, self.N))
+
+    def node_tail(self, x):
+        """
+        Returns the last steps of the trajectory of a walker started on x.
+        """
+
+        if x in self.at_limit:
+            return np.tile(self.limit, (self.horizon, 1))
+
+        if x in self.node_tails:
+            self.node_tails.move_to_end(x)
+            return self.node_tails[x]
+
+        e_x = np.zeros(self.N)
+        e_x[x] = 1.0
+        tail, converged = _propagate_tail(self.Wout_T, e_x, self.t,
+                                          self.horizon, self.tol)
+        if converged and self.limit is not None and \
+                np.abs(tail[-1] - self.limit).sum() <= 1e3 * self.tol:
+            self.at_limit.add(x)
+            return np.tile(self.limit, (self.horizon, 1))
+
+        self.node_tails[x] = tail
+        if len(self.node_tails) > self.cache_size:
+            self.node_tails.popitem(last=False)
+        return tail
+
+    def _merged_nodes(self, macro_mapping):
+        return {i for i, j in macro_mapping.items() if i != j}
+
+    def update(self, macro_mapping):
+        """
+        Updates the cached micro-side trajectory to a newly accepted mapping.
+        """
+
+        merged = self._merged_nodes(macro_mapping)
+        for x in merged - self.merged:
+            self.merged_tail += self.node_tail(x)
+        for x in self.merged - merged:
+            self.merged_tail -= self.node_tail(x)
+        self.merged = merged
+
+    def inaccuracies(self, macro_mapping, G_macro):
+        r"""
+        Returns the inaccuracies of a candidate macro network at the last
+        horizon timesteps (the same values as the end of the series returned
+        by macro_inaccuracy).
+
+        Parameters
+        ----------
+        macro_mapping (dict): the candidate mapping of micro onto macro nodes.
+        G_macro (nx.Graph, np.ndarray or sp.sparse matrix): the candidate
+                    macro network, with the remaining micro nodes first.
+
+        Returns
+        -------
+        inaccuracies (np.ndarray): the last horizon inaccuracies.
+
+        """
+
+        merged = self._merged_nodes(macro_mapping)
+        micro_tail = self.ones_tail - self.merged_tail
+        for x in merged - self.merged:
+            micro_tail = micro_tail - self.node_tail(x)
+        for x in self.merged - merged:
+            micro_tail = micro_tail + self.node_tail(x)
+
+        remaining_micro_nodes = np.array(sorted(
+            j for j in set(macro_mapping.values()) if j < self.N), dtype=int)
+
+        Wout_macro_T = W_out(G_macro, sparse=True).T.tocsr()
+        distribution_over_macro = np.zeros(Wout_macro_T.shape[0])
+        distribution_over_macro[:len(remaining_micro_nodes)] = 1
+        macro_tail, _ = _propagate_tail(Wout_macro_T, distribution_over_macro,
+                                        self.t, self.horizon, self.tol)
+
+        macro_indices = np.arange(len(remaining_micro_nodes))
+        inaccuracies = np.zeros(self.horizon)
+        for ti in range(self.horizon):
+            ED_micro_just_micro = _effect_distribution_just_micro(
+                micro_tail[ti], remaining_micro_nodes)
+            ED_macro_just_micro = _effect_distribution_just_micro(
+                macro_tail[ti], macro_indices)
+            inaccuracies[ti] = _KLD_for_inaccuracy(ED_macro_just_micro,
+                                                   ED_micro_just_micro)
+
+        inaccuracies[inaccuracies < 1e-8] = 0
+
+        return inaccuracies
+
+
+def markov_blanket_pattern(G):
+    r"""
+    Returns the sparsity pattern of the Markov blankets of all the nodes in
+    a network. With $A$ the adjacency matrix ($A_{ij} > 0$ for an edge from
+    $i$ to $j$), the parents, children and parents of the children of node
+    $i$ are the nonzero entries of row $i$ of
+
+        $$ A + A^T + A A^T $$
+
+    without its diagonal. This pattern is symmetric: $j$ is in the Markov
+    blanket of $i$ if and only if $i$ is in the Markov blanket of $j$.
+
+    Parameters
+    ----------
+    G (nx.Graph, np.ndarray or sp.sparse matrix): the network in question.
+
+    Returns
+    -------
+    MB (sp.sparse.csr_matrix): an $N x N$ matrix with sorted indices whose
+                               row $i$ holds the Markov blanket of node $i$.
+
+    """
+
+    if isinstance(G, MicroNetwork):
+        return G.markov_blanket
+
+    A = W_out(G, sparse=True)
+    A = sp.sparse.csr_matrix((np.ones(A.nnz), A.indices, A.indptr),
+                             shape=A.shape)
+
+    MB = A + A.T + A.dot(A.T)
+    MB = (MB - sp.sparse.diags(MB.diagonal())).tocsr()
+    MB.eliminate_zeros()
+    MB.sort_indices()
+
+    return MB
+
+
 def markov_blanket(G, internal_nodes=[]):
     r"""
     Given a graph and a specified (list of) internal node(s), return
@@ -1284,7 +2760,7 @@ def markov_blanket(G, internal_nodes=[]):
 
     Parameters
     ----------
-    G (nx.Graph or np.ndarray): the network in question.
+    G (nx.Graph, np.ndarray or sp.sparse matrix): the network in question.
     internal_nodes (int or list): the nodes around which to build a
                 Markov blanket. If this value is an empty list [],
                 return a dictionary where the keys are the nodes in
@@ -1297,32 +2773,21 @@ def markov_blanket(G, internal_nodes=[]):
                        returns a list. Otherwise, it returns a dictionary
                        where the keys are the nodes in the original graph,
                        and the values are the nodes that constitute their
-                       Markov Blanket
+                       Markov Blanket (in increasing order)
 
     """
 
-    G = check_network(G)
+    pattern = markov_blanket_pattern(G)
     if type(internal_nodes) == int:
         internal_nodes = [internal_nodes]
 
     if internal_nodes == []:
-        internal_nodes = list(G.nodes())
+        internal_nodes = list(range(pattern.shape[0]))
 
     MB = {}
     for node_i in internal_nodes:
-        MB[node_i] = []
-
-        # get the parents and the children
-        parents_i = list(G.predecessors(node_i))
-        children_i = list(G.successors(node_i))
-        MB_i = set(children_i).union(set(parents_i))
-
-        # ...and get their neighbors as well
-        for node_j in children_i:
-            parents_j = list(G.predecessors(node_j))
-            MB_i = set(parents_j).union(MB_i)
-
-        MB[node_i] = [i for i in list(MB_i) if i != node_i]
+        start, end = pattern.indptr[node_i], pattern.indptr[node_i+1]
+        MB[node_i] = pattern.indices[start:end].tolist()
 
     if len(internal_nodes) == 1:
         return {internal_nodes[0]: MB[internal_nodes[0]]}  # fix this
@@ -1331,6 +2796,68 @@ def markov_blanket(G, internal_nodes=[]):
         return MB
 
 
+class MarkovBlanketIndex:
+    r"""
+    A persistent index of the Markov blankets of all the nodes in a network,
+    from which nodes can be removed as they are recruited into macro nodes.
+
+    It plays the role of the dictionary returned by markov_blanket together
+    with update_markov_blanket, but each blanket is a set and, since the
+    blanket relation is symmetric, removing a node only needs to visit the
+    blankets of the nodes in its own blanket, i.e. O(|blanket|) work instead
+    of rebuilding every blanket.
+
+    Parameters
+    ----------
+    G (nx.Graph, np.ndarray or sp.sparse matrix): the network in question.
+
+    """
+
+    def __init__(self, G):
+
+        self.pattern = markov_blanket_pattern(G)
+        self.N = self.pattern.shape[0]
+        self.blankets = [set(self._full_blanket(node_i))
+                         for node_i in range(self.N)]
+        self.removed = set()
+
+    def _full_blanket(self, node_i):
+        start, end = self.pattern.indptr[node_i], self.pattern.indptr[node_i+1]
+        return self.pattern.indices[start:end].tolist()
+
+    def __getitem__(self, node_i):
+        return sorted(self.blankets[node_i])
+
+    def __len__(self):
+        return self.N
+
+    def keys(self):
+        return range(self.N)
+
+    def remove(self, remove_nodes):
+        """
+        Takes the remove_nodes (int or list) out of every Markov blanket.
+        """
+
+        if type(remove_nodes) == int:
+            remove_nodes = [remove_nodes]
+
+        for node_j in remove_nodes:
+            if node_j in self.removed:
+                continue
+
+            self.removed.add(node_j)
+            for node_i in self._full_blanket(node_j):
+                self.blankets[node_i].discard(node_j)
+
+    def to_dict(self):
+        """
+        Returns the current Markov blankets as a dictionary of lists.
+        """
+
+        return {node_i: self[node_i] for node_i in range(self.N)}
+
+
 def update_markov_blanket(MB, remove_nodes=[]):
     r"""
     Given a Markov Blanket dict and a (list of) node(s) that need to be
@@ -1361,6 +2888,7 @@ def update_markov_blanket(MB, remove_nodes=[]):
         return MB
     if type(remove_nodes) == int:
         remove_nodes = [remove_nodes]
+    remove_nodes = set(remove_nodes)
 
     MB_new = {}
     for node_i, blanket_j in MB.items():
@@ -1369,148 +2897,270 @@ def update_markov_blanket(MB, remove_nodes=[]):
     return MB_new
 
 
-def all_possible_mappings(G):
-    r"""
-    This function will return a list of dictionaries, each containing a
-    macro_mapping of the network in question. Be careful with this function
-    though, as the size of the network grows to beyond N = 10, there are too
-    many possible mappings to handle.
+def _connected_sets(root, allowed, neighbors):
+    # every connected set of nodes that contains root and is contained in
+    # allowed, each exactly once: a node of the extension is either added
+    # (bringing its own neighbours into the extension) or forbidden
+    def extend(S, extension, forbidden):
+        yield S
+        extension = list(extension)
+        while extension:
+            v = extension.pop()
+            new_extension = set(extension)
+            new_extension.update(u for u in neighbors[v] if u in allowed and
+                                 u not in S and u not in forbidden)
+            yield from extend(S | {v}, new_extension, forbidden)
+            forbidden = forbidden | {v}
 
-    Uses a function for computing the many permutations "algorithm_u" which
-    I found at this stackoverflow page:
+    return extend(frozenset([root]),
+                  [u for u in neighbors[root] if u in allowed], frozenset())
 
-    https://codereview.stackexchange.com/questions/1526/finding-
-    all-k-subset-partitions
+
+def all_possible_mappings(G, connected=False):
+    r"""
+    Generates every partition of the nodes of a network into macronodes. Each
+    partition is yielded as a compact array of labels, where labels[i] is the
+    index of the block of node i and blocks are numbered in order of their
+    first node (use mapping_from_labels to get a macro_mapping). There are as
+    many partitions as the Bell number of N (115975 for N = 10, 190899322 for
+    N = 14), so with connected=True only the partitions whose blocks are
+    connected in the Markov blanket graph are generated. Those are the only
+    macronodes that causal_emergence can build, and there are far fewer of
+    them on sparse networks.
 
     Parameters
     ----------
     G (nx.Graph or np.ndarray): the network in question.
+    connected (bool): if True, skip partitions with a block that is not
+                      connected in the Markov blanket graph of G.
 
     Returns
     -------
-    mapping_list (list): list of dictionaries of macro_mapping objects
+    labels (generator): of np.ndarray of np.int8, one for each partition.
 
     """
-    def algorithm_u(ns, m):
-        """
-        A very efficient algorithm (Algorithm U) is described by Knuth in the
-        Art of Computer Programming, Volume 4, Fascicle 3B to find all set
-        partitions with a given number of blocks. Since Knuth's algorithm isn't
-        very concise, its implementation is lengthy as well. Note that the
-        implementation below moves an item among the blocks one at a time and
-        need not maintain an accumulator containing all partial results.
-        For this reason, no copying is required.
-        """
 
-        def visit(n, a):
-            ps = [[] for i in range(m)]
-            for j in range(n):
-                ps[a[j + 1]].append(ns[j])
-            return ps
+    MB = markov_blanket_pattern(G) if connected else None
+    G = check_network(G)
+    N = G.number_of_nodes()
+    if N == 0:
+        return
+
+    if connected:
+        neighbors = [MB.indices[MB.indptr[i]:MB.indptr[i+1]].tolist()
+                     for i in range(N)]
+        labels = np.zeros(N, dtype=np.int8)
+
+        # the block of the first node that is not in a block yet is any
+        # connected set of the remaining nodes that contains it
+        def partitions(remaining, block):
+            if not remaining:
+                yield labels.copy()
+                return
+            root = min(remaining)
+            for S in _connected_sets(root, remaining, neighbors):
+                labels[list(S)] = block
+                yield from partitions(remaining - S, block + 1)
+
+        yield from partitions(frozenset(range(N)), 0)
 
-        def f(mu, nu, sigma, n, a):
-            if mu == 2:
-                yield visit(n, a)
-            else:
-                for v in f(mu - 1, nu - 1, (mu + sigma) % 2, n, a):
-                    yield v
-            if nu == mu + 1:
-                a[mu] = mu - 1
-                yield visit(n, a)
-                while a[nu] > 0:
-                    a[nu] = a[nu] - 1
-                    yield visit(n, a)
-            elif nu > mu + 1:
-                if (mu + sigma) % 2 == 1:
-                    a[nu - 1] = mu - 1
-                else:
-                    a[mu] = mu - 1
-                if (a[nu] + sigma) % 2 == 1:
-                    for v in b(mu, nu - 1, 0, n, a):
-                        yield v
-                else:
-                    for v in f(mu, nu - 1, 0, n, a):
-                        yield v
-                while a[nu] > 0:
-                    a[nu] = a[nu] - 1
-                    if (a[nu] + sigma) % 2 == 1:
-                        for v in b(mu, nu - 1, 0, n, a):
-                            yield v
-                    else:
-                        for v in f(mu, nu - 1, 0, n, a):
-                            yield v
-
-        def b(mu, nu, sigma, n, a):
-            if nu == mu + 1:
-                while a[nu] < mu - 1:
-                    yield visit(n, a)
-                    a[nu] = a[nu] + 1
-                yield visit(n, a)
-                a[mu] = 0
-            elif nu > mu + 1:
-                if (a[nu] + sigma) % 2 == 1:
-                    for v in f(mu, nu - 1, 0, n, a):
-                        yield v
-                else:
-                    for v in b(mu, nu - 1, 0, n, a):
-                        yield v
-                while a[nu] < mu - 1:
-                    a[nu] = a[nu] + 1
-                    if (a[nu] + sigma) % 2 == 1:
-                        for v in f(mu, nu - 1, 0, n, a):
-                            yield v
-                    else:
-                        for v in b(mu, nu - 1, 0, n, a):
-                            yield v
-                if (mu + sigma) % 2 == 1:
-                    a[nu - 1] = 0
-                else:
-                    a[mu] = 0
-            if mu == 2:
-                yield visit(n, a)
-            else:
-                for v in b(mu - 1, nu - 1, (mu + sigma) % 2, n, a):
-                    yield v
+    else:
+        # restricted growth strings: labels[i] <= max(labels[:i]) + 1
+        labels = [0] * N
+        largest = [0] * N
+        while True:
+            yield np.array(labels, dtype=np.int8)
+
+            i = N - 1
+            while i > 0 and labels[i] == largest[i-1] + 1:
+                i -= 1
+            if i == 0:
+                return
+
+            labels[i] += 1
+            largest[i] = max(largest[i-1], labels[i])
+            for j in range(i + 1, N):
+                labels[j] = 0
+                largest[j] = largest[i]
+
+
+def mapping_from_labels(labels):
+    """
+    Turns an array of block labels (as yielded by all_possible_mappings) into
+    a macro_mapping, where singletons stay micro nodes and the other blocks
+    become macronodes N, N+1, ... in order of their label.
 
-        n = len(ns)
-        a = [0] * (n + 1)
-        for j in range(1, m + 1):
-            a[n - m + j] = j - 1
-        return f(m, n, 0, n, a)
+    Parameters
+    ----------
+    labels (np.ndarray): the block of each node.
 
-    G = check_network(G)
-    N = G.number_of_nodes()
-    nodes = list(G.nodes())
-    if len(nodes) > 10:
-        print("Comment this out if you really want to run a network that big.")
-        return []
+    Returns
+    -------
+    macro_mapping (dict): a dictionary where the keys are the microscale nodes
+                          and the values are the macronodes they belong to.
+
+    """
+
+    N = len(labels)
+    sizes = np.bincount(labels)
+    macro_ids = N + np.cumsum(sizes > 1) - 1
+
+    return {i: i if sizes[lab] == 1 else int(macro_ids[lab])
+            for i, lab in enumerate(labels)}
+
+
+def _partitions_EI(labels, Wout, micro_stationary):
+    """
+    $EI$ of the spatem1 macro networks of a batch of partitions, given as a
+    (B, N) array of labels, computed at once with dense (B, N, N) arrays.
+    Matches effective_information(create_macro(...)) for every partition.
+    """
+
+    B, N = labels.shape
+    P = np.zeros((B, N, N))
+    P[np.arange(B)[:, None], np.arange(N)[None, :], labels] = 1.0
+    PT = P.transpose(0, 2, 1)
+    sizes = P.sum(axis=1)
+
+    # singletons keep the out-weights of their micro node, the rest are
+    # lumped by their stationary flows
+    T_micro = PT @ (Wout @ P)
+    C = PT @ ((micro_stationary[:, None] * Wout) @ P)
+    macro_stationary = PT @ micro_stationary
+
+    diagonal = np.arange(N)
+    exits = C.sum(axis=2) - C[:, diagonal, diagonal]
+    T_macro = C.copy()
+    T_macro[:, diagonal, diagonal] = 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        T_macro /= macro_stationary[:, :, None]
+        selfloop = np.maximum(1 - exits / macro_stationary, 0)
+    T_macro[exits == 0] = 0
+    selfloop[exits == 0] = 1.0
+    T_macro[:, diagonal, diagonal] = selfloop
+
+    T = np.where((sizes == 1)[:, :, None], T_micro, 0.0)
+    T = np.where((sizes > 1)[:, :, None], T_macro, T)
+
+    # the same normalization and EI as W_out and effective_information
+    row_sum = T.sum(axis=2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        T = np.where(row_sum[:, :, None] > 0, T / row_sum[:, :, None], 0.0)
+    Nout = np.count_nonzero(row_sum > 0, axis=1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        plogp = np.where(T > 0, T * np.log2(T), 0.0)
+        Win = T.sum(axis=1) / Nout[:, None]
+        Win = Win / Win.sum(axis=1, keepdims=True)
+        Win_entropy = -np.where(Win > 0, Win * np.log2(Win), 0.0).sum(axis=1)
+        EI = Win_entropy + plogp.sum(axis=(1, 2)) / Nout
 
-    mapping_list = []
-    list_of_lists_of_mappings = [[nodes]]
+    EI[Nout == 0] = 0.0
+    return EI
 
-    for i in range(2, N+1):  # this must be from 2! if from 1, it breaks
-        x = list(algorithm_u(nodes, i))  # key step
 
-        for j in x:
-            list_of_lists_of_mappings.append(j)
+def _top_k(EI, labels, index, top_k):
+    # best top_k partitions, ties broken by the order of enumeration
+    best = np.lexsort((index, -EI))[:top_k]
+    return EI[best], labels[best], index[best]
+
+
+# state of each worker process that scores partitions in parallel
+_partition_worker = {}
+
+
+def _init_partition_worker(Wout, micro_stationary, top_k):
+    _partition_worker['Wout'] = Wout
+    _partition_worker['micro_stationary'] = micro_stationary
+    _partition_worker['top_k'] = top_k
+
+
+def _score_partitions(labels, index, Wout=None, micro_stationary=None,
+                      top_k=None):
+    # in a worker process, the micro network is the one in _partition_worker
+    if Wout is None:
+        Wout = _partition_worker['Wout']
+        micro_stationary = _partition_worker['micro_stationary']
+        top_k = _partition_worker['top_k']
+
+    EI = _partitions_EI(labels.astype(np.intp), Wout, micro_stationary)
+    return _top_k(EI, labels, index, top_k)
+
+
+def best_possible_mappings(G, top_k=10, connected=True, n_jobs=1,
+                           batch_size=4096):
+    r"""
+    Exhaustive search for the macro_mappings (with spatem1 macronodes) that
+    maximize the $EI$ of the macroscale network, e.g. to validate the greedy
+    and spectral algorithms on small networks. The partitions streamed by
+    all_possible_mappings are scored in batches of batch_size, spread over
+    n_jobs worker processes, and only the top_k are kept in memory. With
+    connected=True this is feasible for networks of 12 to 14 nodes.
+
+    Parameters
+    ----------
+    G (nx.Graph or np.ndarray): the network in question.
+    top_k (int): number of best mappings to return.
+    connected (bool): if True, only macronodes that are connected in the
+                      Markov blanket graph are considered.
+    n_jobs (int): number of worker processes (-1 uses all the CPUs).
+    batch_size (int): number of partitions scored at once.
 
-    for mapping in list_of_lists_of_mappings:
-        out_dict = dict(zip(nodes, [-1]*len(nodes)))
-        MacroID = max(nodes)  # or len(nodes)
+    Returns
+    -------
+    best (list): of (EI_macro, macro_mapping) tuples, by decreasing $EI$.
 
-        for mac in mapping:
-            if len(mac) > 1:
-                MacroID += 1
-                for i in mac:
-                    out_dict[i] = MacroID
+    """
 
+    G_micro = _micro_network(G)
+    Wout = W_out(G_micro)
+    micro_stationary = G_micro.stationary
+    N = Wout.shape[0]
+
+    best = (np.zeros(0), np.zeros((0, N), dtype=np.int8),
+            np.zeros(0, dtype=np.int64))
+
+    def merge(best, result):
+        return _top_k(*[np.concatenate((x, y)) for x, y in zip(best, result)],
+                      top_k)
+
+    pool = None
+    if n_jobs != 1:
+        n_workers = os.cpu_count() if n_jobs == -1 else n_jobs
+        pool = ProcessPoolExecutor(max_workers=n_workers,
+                                   initializer=_init_partition_worker,
+                                   initargs=(Wout, micro_stationary, top_k))
+
+    try:
+        partitions = all_possible_mappings(G_micro, connected=connected)
+        pending = []
+        start = 0
+        while True:
+            batch = list(itertools.islice(partitions, batch_size))
+            if not batch:
+                break
+            labels = np.array(batch)
+            index = np.arange(start, start + len(batch))
+            start += len(batch)
+
+            if pool is None:
+                best = merge(best, _score_partitions(labels, index, Wout,
+                                                     micro_stationary, top_k))
             else:
-                for i in mac:
-                    out_dict[i] = i
+                # keep a bounded number of batches in flight
+                pending.append(pool.submit(_score_partitions, labels, index))
+                if len(pending) >= 2 * n_workers:
+                    best = merge(best, pending.pop(0).result())
 
-        mapping_list.append(out_dict)
+        for future in pending:
+            best = merge(best, future.result())
 
-    return mapping_list
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    return [(float(EI), mapping_from_labels(labels))
+            for EI, labels, _ in zip(*best)]
 
 
 def intervention_distribution(G, macro_mapping,
@@ -1663,7 +3313,41 @@ def reorder_elements(Win_micro, macro_mapping):
     return Win_micro_given_macro
 
 
-def construct_distance_matrix(G_micro, nonz=1e-3, dist_add=1e3):
+def _leading_eigenpairs(Wout, nonz=1e-3, k=16, max_k=128, tol=0):
+    """
+    Leading eigenpairs of the sparse matrix Wout, computed with ARPACK. The
+    number of eigenpairs, k, is doubled until the smallest eigenvalue found
+    has decayed below nonz, but never beyond max_k: on most networks many
+    more than max_k eigenvalues are larger than nonz, and the spectrum is
+    then truncated (the third value returned is True). The full dense
+    decomposition is only used when k would get too close to N.
+
+    Eigenvectors are normalized as in np.linalg.eig: unit norm, with their
+    largest component real and positive.
+    """
+
+    N = Wout.shape[0]
+    k = min(k, max_k)
+    while True:
+        if k >= N - 1:
+            lam, eig = np.linalg.eig(Wout.toarray())
+            return lam, eig, False
+
+        lam, eig = sp.sparse.linalg.eigs(Wout, k=k, which='LM', tol=tol)
+        if np.abs(lam).min() <= nonz or k >= max_k:
+            break
+        k = min(2 * k, max_k)
+
+    # fix the arbitrary phase that ARPACK leaves on each eigenvector
+    largest = eig[np.abs(eig).argmax(axis=0), np.arange(eig.shape[1])]
+    eig = eig * (np.abs(largest) / largest)
+
+    return lam, eig, bool(np.abs(lam).min() > nonz)
+
+
+def construct_distance_matrix(G_micro, nonz=1e-3, dist_add=1e3,
+                              method='auto', k=16, sparse=False, max_k=128,
+                              return_info=False):
     r"""
     Make distance matrix for OPTICS algorithm for spectral causal emergence.
     This is done through an eigendecomposition of the transition probability
@@ -1674,7 +3358,18 @@ def construct_distance_matrix(G_micro, nonz=1e-3, dist_add=1e3):
         $$ W_{out} = E \Lambda E^T $$
 
     where columns in $E$ corresponds to the eigenvectors of nodes in G_micro,
-    weighted by the eigenvalue they are associated with.
+    weighted by the eigenvalue they are associated with. Only eigenvalues
+    larger than nonz matter, so the leading eigenpairs can be computed with
+    a sparse solver (ARPACK) instead of the full $O(N^3)$ decomposition.
+    This is only faster when few eigenvalues are larger than nonz, and is
+    an approximation when more than max_k of them are, so it has to be
+    asked for with method='sparse'.
+
+    With sparse=True, cosine distances are only computed between nodes in
+    each other's Markov blankets, and the result is a sparse neighbourhood
+    graph that OPTICS accepts as a precomputed metric. Missing entries are
+    never neighbours, which is what dist_add achieves in the dense matrix,
+    so both give the same OPTICS ordering.
 
 
         Development work contributed by Ross Griebenow.
@@ -1690,46 +3385,240 @@ def construct_distance_matrix(G_micro, nonz=1e-3, dist_add=1e3):
                       purposes, only ~1000 is needed in order to only measure
                       the distance between nodes within each nodes' Markov
                       blankets.
+    method (str): one of 'dense' (np.linalg.eig), 'sparse' (leading
+                  eigenpairs, starting from k and doubling k until the
+                  eigenvalues have decayed below nonz or k reaches max_k)
+                  or 'auto' (default), which currently is 'dense'.
+    k (int): initial number of eigenpairs computed by the sparse method.
+    sparse (bool): if True, return the Markov blanket distances as a sparse
+                   matrix instead of the dense $N x N$ distance matrix.
+    max_k (int): largest number of eigenpairs computed by the sparse method.
+                 If the spectrum is truncated there (the smallest eigenvalue
+                 found is still larger than nonz), a warning is raised.
+    return_info (bool): if True, also return a dictionary describing the
+                        eigendecomposition.
 
     Returns
     -------
-    dist (np.ndarray): the distance matrix upon which the OPTICS algorithm
-                       will perform spectral clustering with different distance
-                       thresholds, $\epsilon$
+    dist (np.ndarray or sp.sparse.csr_matrix): the distance matrix upon which
+                       the OPTICS algorithm will perform spectral clustering
+                       with different distance thresholds, $\epsilon$
+    info (dict): only if return_info is True, with the method used, the
+                 number of eigenpairs kept, whether the spectrum was
+                 truncated and the smallest eigenvalue magnitude computed.
 
     """
 
-    Wout = W_out(G_micro)
-    lam, eig = np.linalg.eig(Wout)
+    Wout = W_out(G_micro, sparse=True)
+    N = Wout.shape[0]
+
+    if method == 'auto':
+        method = 'dense'
+
+    truncated = False
+    if method == 'dense':
+        lam, eig = np.linalg.eig(Wout.toarray())
+    elif method == 'sparse':
+        lam, eig, truncated = _leading_eigenpairs(Wout, nonz, k, max_k)
+        if truncated:
+            warnings.warn("the spectrum was truncated at max_k=%i "
+                          "eigenpairs, whose smallest eigenvalue (%.3g) is "
+                          "still larger than nonz=%g, so the distances are "
+                          "approximate" % (len(lam), np.abs(lam).min(), nonz))
+    else:
+        raise ValueError("method must be one of 'auto', 'dense' or "
+                         "'sparse', not %r" % (method,))
+
     span = np.nonzero(np.abs(np.real(lam)) > nonz)[0]
+    info = {'method': method, 'n_eigenpairs': len(span),
+            'truncated': truncated,
+            'smallest_eigenvalue': float(np.abs(lam).min()) if len(lam)
+            else 0.0}
 
     # weight the eigenvectors by their corresponding eigenvalues
     M = np.real(eig)[:, span] * np.real(lam)[span]
 
+    if sparse:
+        MB = markov_blanket_pattern(G_micro)
+        rows = np.repeat(np.arange(N), np.diff(MB.indptr))
+        cols = MB.indices
+
+        # same cosine distances as pdist, one Markov blanket at a time
+        distances = np.zeros(MB.nnz)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for i in np.nonzero(np.diff(MB.indptr))[0]:
+                blanket = slice(MB.indptr[i], MB.indptr[i+1])
+                distances[blanket] = sp.spatial.distance.cdist(
+                    M[i:i+1], M[cols[blanket]], metric='cosine')[0]
+        distances[np.isnan(distances)] = 0
+
+        # round the distances exactly as adding and removing dist_add does
+        # in the dense matrix, so that OPTICS sees the same values
+        distances = (distances + dist_add) - dist_add
+
+        # as in the dense matrix, each node is dist_add away from itself.
+        # OPTICS needs every row to hold at least min_samples=2 entries, so
+        # nodes with an empty Markov blanket also get one far neighbour
+        lonely = np.nonzero(np.bincount(rows, minlength=N) == 0)[0]
+        rows = np.concatenate((rows, np.arange(N), lonely))
+        cols = np.concatenate((cols, np.arange(N), (lonely + 1) % N))
+        distances = np.concatenate((distances, np.full(N, dist_add),
+                                    np.full(len(lonely), dist_add)))
+
+        dist = sp.sparse.csr_matrix((distances, (rows, cols)), shape=(N, N))
+        if return_info:
+            return dist, info
+        return dist
+
     # create values for a distance matrix, which will become the output
     distance_vector = sp.spatial.distance.pdist(M, metric='cosine')
 
     dist = sp.spatial.distance.squareform(distance_vector)
     dist[np.isnan(dist)] = 0
 
-    MB = markov_blanket(G_micro)
-    for i in range(G_micro.number_of_nodes()):
-        dist[:, i] += dist_add
-        dist[MB[i], i] -= dist_add
+    # only distances within each node's Markov blanket stay small
+    MB = markov_blanket_pattern(G_micro)
+    dist += dist_add
+    dist[MB.nonzero()] -= dist_add
 
+    if return_info:
+        return dist, info
     return dist
 
 
+def _canonical_labels(labels):
+    # relabel the clusters of an OPTICS labelling (noise stays -1) in order of
+    # their first node, so that equal partitions get equal labellings
+    clustered = labels >= 0
+    _, first, inverse = np.unique(labels[clustered], return_index=True,
+                                  return_inverse=True)
+    canonical = np.full(len(labels), -1)
+    canonical[clustered] = np.argsort(np.argsort(first))[inverse]
+
+    return canonical
+
+
+def _epsilon_macro_EI(macro_mapping, Wout_micro=None, micro_stationary=None):
+    # in a worker process, the micro network is the one in _epsilon_worker
+    if Wout_micro is None:
+        Wout_micro = _epsilon_worker['Wout_micro']
+        micro_stationary = _epsilon_worker['micro_stationary']
+
+    macro_types = {i: 'spatem1' for i in macro_mapping.values()
+                   if i > max(macro_mapping.keys())}
+    G_macro = create_macro(Wout_micro, macro_mapping, macro_types,
+                           sparse=True, micro_stationary=micro_stationary)
+
+    return effective_information(G_macro)
+
+
+# state of each worker process that scores epsilon mappings in parallel
+_epsilon_worker = {}
+
+
+def _init_epsilon_worker(Wout_micro, micro_stationary):
+    _epsilon_worker['Wout_micro'] = Wout_micro
+    _epsilon_worker['micro_stationary'] = micro_stationary
+
+
+class EpsilonSearch:
+    """
+    Scores the macro networks obtained by cutting an OPTICS reachability plot
+    at different epsilons. Many epsilons give the same clusters, so the $EI$
+    of each partition is cached under its canonical labelling and every
+    partition is only coarse-grained once. The new partitions of a batch of
+    epsilons can be scored concurrently by n_jobs worker processes.
+
+    Parameters
+    ----------
+    reach, core, order (optics parameters): outputs from the original run of
+                        the OPTICS algorithm.
+    G_micro (nx.Graph or np.ndarray): the microscale network in question.
+    micro_stationary (np.ndarray): the stationary distribution of G_micro.
+    n_jobs (int): number of worker processes (-1 uses all the CPUs).
+
+    """
+
+    def __init__(self, reach, core, order, G_micro, micro_stationary=None,
+                 n_jobs=1):
+        self.reach = reach
+        self.core = core
+        self.order = order
+        self.Wout_micro = W_out(G_micro, sparse=True)
+        if micro_stationary is None:
+            micro_stationary = stationary_distribution(self.Wout_micro)
+        self.micro_stationary = micro_stationary
+
+        # canonical labelling -> (EI, macro_mapping)
+        self.cache = {}
+        self.n_evaluations = 0
+
+        self.pool = None
+        if n_jobs != 1:
+            self.pool = ProcessPoolExecutor(
+                max_workers=os.cpu_count() if n_jobs == -1 else n_jobs,
+                initializer=_init_epsilon_worker,
+                initargs=(self.Wout_micro, self.micro_stationary))
+
+    def labels(self, eps):
+        """OPTICS cluster labels of every node at a given epsilon."""
+        return cluster_optics_dbscan(reachability=self.reach,
+                                     core_distances=self.core,
+                                     ordering=self.order, eps=max(eps, 0))
+
+    def evaluate(self, epsilons):
+        """
+        Returns a list with the $EI$ and the macro_mapping of each epsilon,
+        only coarse-graining the partitions that are not cached yet.
+        """
+
+        keys = []
+        new = {}
+        for eps in epsilons:
+            labs_e = self.labels(eps)
+            key = _canonical_labels(labs_e).tobytes()
+            keys.append(key)
+            if key not in self.cache and key not in new:
+                new[key] = {i: i if lab == -1 else (len(labs_e)+lab)
+                            for i, lab in enumerate(labs_e)}
+
+        mappings = list(new.values())
+        if self.pool is not None and len(mappings) > 1:
+            EIs = list(self.pool.map(_epsilon_macro_EI, mappings))
+        else:
+            EIs = [_epsilon_macro_EI(macro_mapping, self.Wout_micro,
+                                     self.micro_stationary)
+                   for macro_mapping in mappings]
+
+        self.n_evaluations += len(mappings)
+        for key, EI, macro_mapping in zip(new, EIs, mappings):
+            self.cache[key] = (EI, macro_mapping)
+
+        return [self.cache[key] for key in keys]
+
+    def close(self):
+        """Shuts down the worker processes, if any."""
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+
 def find_epsilon_mapping(reach, core, order, G_micro, depth=4,
-                         min_ep=1e-4, max_ep=9.99e-1, scale=1e-4):
+                         min_ep=1e-4, max_ep=9.99e-1, scale=1e-4,
+                         micro_stationary=None, strategy='ternary',
+                         n_grid=50, n_jobs=1, search=None):
     r"""
-    Binary search down the tree of possible epsilon values for finding the one
-    that returns a macroscale mapping that maximizes the effective information
+    Search the tree of possible epsilon values for finding the one that
+    returns a macroscale mapping that maximizes the effective information
     of the resulting macroscale network. The spectral algorithm OPTICS creates
     a mapping of of points to clusters based on a distance matrix, which itself
     was generated by eigendecomposing the transition probability matrix of
     G_micro, the original graph.
 
+    The $EI$ of every partition is cached (see EpsilonSearch), so epsilons
+    that are re-visited, or that give the same clusters, are never
+    coarse-grained twice.
+
     Algorithm adapted from the paper:
         Mihael Ankerst. Markus M. Breunig, Hans-Peter Kriegel, & Jörg Sander
         “OPTICS: Ordering points to identify the clustering structure”.
@@ -1747,60 +3636,101 @@ def find_epsilon_mapping(reach, core, order, G_micro, depth=4,
     min_ep (float): the minimum value to check for grouping nodes into macros
     max_ep (float): the maximum value to check for grouping nodes into macros
     scale (float): the smallest value to use for re-updating the epsilon range
+    micro_stationary (np.ndarray): the stationary distribution of G_micro,
+                computed once here if None.
+    strategy (str): how the epsilons are searched:
+                - 'ternary' (default): evaluates three epsilons per level
+                  and narrows the range around the best one, depth+1 times.
+                - 'golden': golden-section search, narrowing the range
+                  depth times with one new epsilon per level.
+                - 'grid': evaluates n_grid evenly spaced epsilons at once.
+    n_grid (int): number of epsilons of the 'grid' strategy.
+    n_jobs (int): number of worker processes that score the epsilons of a
+                  level concurrently (-1 uses all the CPUs).
+    search (EpsilonSearch): an existing search whose cache is reused, e.g.
+                to try several strategies on the same OPTICS run. If None,
+                a new one is created (and shut down) here.
 
     Returns
     -------
-    if depth==0:
-        EI_macro (float): the $EI$ of the macro_mapping that was selected
-        macro_mapping (dict): the macroscale mapping that maximizes the $EI$
-                              of the resulting macroscale network, G_macro.
+    EI_macro (float): the $EI$ of the macro_mapping that was selected
+    macro_mapping (dict): the macroscale mapping that maximizes the $EI$
+                          of the resulting macroscale network, G_macro.
 
     """
 
-    eps_range = (max_ep - min_ep)*scale
-    epsilon_ei = []
-    epsilon_range = np.linspace(min_ep, max_ep, 3)
-    epsilon_mappings = []
-
-    for eps in epsilon_range:
-
-        labs_e = cluster_optics_dbscan(reachability=reach, core_distances=core, ordering=order, eps=eps)
+    own_search = search is None
+    if own_search:
+        search = EpsilonSearch(reach, core, order, G_micro,
+                               micro_stationary=micro_stationary,
+                               n_jobs=n_jobs)
+
+    try:
+        if strategy == 'ternary':
+            for level in range(depth, -1, -1):
+                eps_range = (max_ep - min_ep)*scale
+                epsilon_range = np.linspace(min_ep, max_ep, 3)
+                epsilon_ei = [EI for EI, _ in search.evaluate(epsilon_range)]
+
+                if level == 0:
+                    break
+
+                if epsilon_ei[1] >= epsilon_ei[2] and \
+                        epsilon_ei[1] >= epsilon_ei[0]:
+                    max_ep = (epsilon_range[1] + epsilon_range[2]) / 2 + \
+                        eps_range
+                    min_ep = (epsilon_range[1] + epsilon_range[0]) / 2 - \
+                        eps_range
+
+                elif epsilon_ei[0] >= epsilon_ei[2] and \
+                        epsilon_ei[0] >= epsilon_ei[1]:
+                    max_ep = epsilon_range[1] + eps_range
+                    min_ep = epsilon_range[0] - eps_range
 
-        macro_mapping_e = {i: i if lab == -1 else (len(labs_e)+lab)
-                           for i, lab in enumerate(labs_e)}
-        macro_types_e = {i: 'spatem1' for i in macro_mapping_e.values()
-                         if i > max(macro_mapping_e.keys())}
-
-        Gm_e = create_macro(G_micro, macro_mapping_e, macro_types_e)
-        G_macro_e = check_network(Gm_e)
-
-        EI_macro_e = effective_information(G_macro_e)
-        epsilon_ei.append(EI_macro_e)
-        epsilon_mappings.append(macro_mapping_e)
+                else:
+                    max_ep = epsilon_range[2] + eps_range
+                    min_ep = epsilon_range[1] - eps_range
+
+            candidates = epsilon_range
+
+        elif strategy == 'golden':
+            invphi = (np.sqrt(5) - 1) / 2
+            a, b = min_ep, max_ep
+            c, d = b - invphi*(b - a), a + invphi*(b - a)
+            (EI_c, _), (EI_d, _) = search.evaluate([c, d])
+            candidates = [c, d]
+            for _ in range(depth):
+                if EI_c >= EI_d:
+                    b, d, EI_d = d, c, EI_c
+                    c = b - invphi*(b - a)
+                    EI_c = search.evaluate([c])[0][0]
+                    candidates.append(c)
+                else:
+                    a, c, EI_c = c, d, EI_d
+                    d = a + invphi*(b - a)
+                    EI_d = search.evaluate([d])[0][0]
+                    candidates.append(d)
 
-    if depth == 0:
-        ind = np.argmax(epsilon_ei)
-        return epsilon_ei[ind], epsilon_mappings[ind]
+        elif strategy == 'grid':
+            candidates = np.linspace(min_ep, max_ep, n_grid)
 
-    else:
-        if epsilon_ei[1] >= epsilon_ei[2] and epsilon_ei[1] >= epsilon_ei[0]:
-            new_max = (epsilon_range[1] + epsilon_range[2]) / 2 + eps_range
-            new_min = (epsilon_range[1] + epsilon_range[0]) / 2 - eps_range
+        else:
+            raise ValueError("strategy must be one of 'ternary', 'golden' "
+                             "or 'grid', not %r" % (strategy,))
 
-        elif epsilon_ei[0] >= epsilon_ei[2] and epsilon_ei[0] >= epsilon_ei[1]:
-            new_max = epsilon_range[1] + eps_range
-            new_min = epsilon_range[0] - eps_range
+        results = search.evaluate(candidates)
 
-        else:
-            new_max = epsilon_range[2] + eps_range
-            new_min = epsilon_range[1] - eps_range
+    finally:
+        if own_search:
+            search.close()
 
-        return find_epsilon_mapping(reach, core, order, G_micro,
-                                    depth=depth-1, min_ep=new_min,
-                                    max_ep=new_max, scale=scale)
+    ind = np.argmax([EI for EI, _ in results])
+    return results[ind]
 
 
-def causal_emergence_spectral(G, check_inacc=False, t=500, dev=False):
+def causal_emergence_spectral(G, check_inacc=False, t=500, dev=False,
+                              eig_method='auto', eps_strategy='ternary',
+                              n_jobs=1):
     r"""
     Given a microscale network, G, this function computes a macroscale mapping,
     macro_mapping, using a spectral clustering method such that when G is
@@ -1816,6 +3746,11 @@ def causal_emergence_spectral(G, check_inacc=False, t=500, dev=False):
     t (int): default to 10, this the number of timesteps over which inaccuracy
              is evaluated.
     dev (bool): default to False, if True it returns more details in a dictionary.
+    eig_method (str): eigendecomposition used for the distance matrix, see
+                      the method parameter of construct_distance_matrix.
+    eps_strategy (str): how the OPTICS epsilons are searched, see the
+                        strategy parameter of find_epsilon_mapping.
+    n_jobs (int): number of worker processes that score epsilons concurrently.
 
     Returns
     -------
@@ -1836,10 +3771,11 @@ def causal_emergence_spectral(G, check_inacc=False, t=500, dev=False):
 
     """
 
-    G_micro = check_network(G)
-    EI_micro = effective_information(G_micro)
+    micro = _micro_network(G)
+    G_micro = micro.G
+    EI_micro = micro.EI
 
-    dist = construct_distance_matrix(G_micro)
+    dist = construct_distance_matrix(micro, method=eig_method, sparse=True)
 
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
@@ -1850,9 +3786,12 @@ def causal_emergence_spectral(G, check_inacc=False, t=500, dev=False):
     core = optics.core_distances_
     order = optics.ordering_
 
-    EI_macro, macro_mapping = find_epsilon_mapping(reach, core, order, G_micro)
+    micro_stationary = micro.stationary
+    EI_macro, macro_mapping = find_epsilon_mapping(
+        reach, core, order, micro, micro_stationary=micro_stationary,
+        strategy=eps_strategy, n_jobs=n_jobs)
 
-    macro_types = {i: 'spatem1' for i, j in macro_mapping.items() if i != j}
+    macro_types = {j: 'spatem1' for i, j in macro_mapping.items() if i != j}
 
     CE = {}
     if macro_types == {}:
@@ -1860,7 +3799,8 @@ def causal_emergence_spectral(G, check_inacc=False, t=500, dev=False):
         G_macro = G_micro.copy()
 
     else:
-        G_macro = create_macro(G_micro, macro_mapping, macro_types)
+        G_macro = create_macro(micro, macro_mapping, macro_types,
+                               micro_stationary=micro_stationary)
         G_macro = check_network(G_macro)
 
     macro_labels = np.unique(sorted(macro_mapping.values()))
@@ -1868,14 +3808,14 @@ def causal_emergence_spectral(G, check_inacc=False, t=500, dev=False):
                                     dict(zip(list(G_macro.nodes()),
                                              macro_labels)))
     CE['G_macro'] = G_macro_out
-    CE['G_micro'] = G_micro
+    CE['G_micro'] = G_micro.copy()
     CE['mapping'] = macro_mapping
     CE['macro_types'] = macro_types
     CE['EI_micro'] = EI_micro
     CE['EI_macro'] = EI_macro
 
     if check_inacc:
-        inaccuracies = macro_inaccuracy(G_micro, G_macro, macro_mapping,
+        inaccuracies = macro_inaccuracy(micro, G_macro, macro_mapping,
                                         macro_types, t)
         CE['inaccuracy'] = inaccuracies['inaccuracies']
 
@@ -12,16 +12,349 @@ author: Harrison Hartle
 email: hthartle1 at gmail dot com
 """
 
-from collections import Counter
+import warnings
 import numpy as np
 import networkx as nx
 from scipy.linalg import expm, sinm, cosm
 import matplotlib.pyplot as plt
 import pandas as pd
 import scipy.linalg as li
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.sparse.linalg import eigsh, expm_multiply
+from scipy.stats import poisson
 
 
-def laplacian_renormalization(G, tau, dev=False):
+def _metagraph_components(rho):
+    """
+    Connected components of the metagraph of a density matrix, in which
+    nodes i and j are linked if rho_ij >= rho_jj or rho_ij >= rho_ii.
+
+    Parameters
+    ----------
+    rho (np.ndarray): the n x n density matrix e^(-tau L) / Z.
+
+    Returns
+    -------
+    components (np.ndarray): the component of each node.
+
+    """
+
+    d = np.diag(rho)
+    metagraph = (rho >= d[np.newaxis, :]) | (rho >= d[:, np.newaxis])
+    _, components = connected_components(csr_matrix(metagraph),
+                                         directed=False)
+
+    return components
+
+
+def _supernode_labels(components):
+    """
+    Label each node by its supernode: nodes alone in their component keep
+    their own index, and the components with more than one node are labelled
+    n, n+1, ... in the order of their smallest node.
+
+    Parameters
+    ----------
+    components (np.ndarray): the component of each node.
+
+    Returns
+    -------
+    labels (np.ndarray): the label of each node.
+
+    """
+
+    components = np.asarray(components)
+    n = len(components)
+    _, first, inverse, sizes = np.unique(components, return_index=True,
+                                         return_inverse=True,
+                                         return_counts=True)
+
+    # rank the supernodes by their smallest node
+    order = np.argsort(first, kind='stable')
+    is_super = sizes[order] > 1
+    rank = np.empty(len(first), dtype=int)
+    rank[order] = np.cumsum(is_super) - 1
+
+    inverse = inverse.ravel()
+    return np.where(sizes[inverse] > 1, n + rank[inverse], np.arange(n))
+
+
+def _smallest_eigenpairs(L, k):
+    """
+    The k smallest eigenpairs of a sparse Laplacian, by shift-invert Lanczos
+    around 0 (or a dense eigh if k is close to the number of nodes).
+    """
+
+    n = L.shape[0]
+    if k >= n - 1:
+        eigenvalues, V = li.eigh(L.toarray())
+        return eigenvalues[:k], V[:, :k]
+
+    eigenvalues, V = eigsh(L, k=k, sigma=-1e-3, which='LM')
+    order = np.argsort(eigenvalues)
+
+    return eigenvalues[order], V[:, order]
+
+
+def _hutchinson_trace(L, tau, n_probes, seed=None, eigenvalues=None,
+                      V=None):
+    """
+    Stochastic estimate of Z = tr(e^(-tau L)) from Rademacher probes, each
+    propagated with a Krylov expm_multiply. If some eigenpairs are given,
+    their part of the trace is exact and only the rest is estimated.
+    """
+
+    rng = np.random.default_rng(seed)
+    probes = rng.choice([-1.0, 1.0], size=(L.shape[0], n_probes))
+    estimates = (probes * expm_multiply(-tau * L, probes)).sum(axis=0)
+
+    Z = 0.0
+    if V is not None:
+        weights = np.exp(-tau * eigenvalues)
+        estimates -= (weights[:, np.newaxis] * (V.T @ probes)**2).sum(axis=0)
+        Z = weights.sum()
+
+    return Z + estimates.mean()
+
+
+def _blockwise_components(n, column_blocks, margin=0.0):
+    """
+    Connected components of the metagraph of a heat kernel K streamed by
+    blocks of columns, without holding more than one block in memory. As K
+    is symmetric, the link i-j is found in the block of column j (if
+    K_ij >= K_jj) or in the block of column i (if K_ji >= K_ii). The links
+    found so far are kept as a spanning star of each component.
+
+    Parameters
+    ----------
+    n (int): the number of nodes.
+    column_blocks (iterable): pairs (columns, K[:, columns]).
+    margin (float): comparisons closer than this to their threshold are
+                    counted as uncertain.
+
+    Returns
+    -------
+    components (np.ndarray): the component of each node.
+    n_uncertain (int): the number of uncertain comparisons.
+
+    """
+
+    nodes = np.arange(n)
+    representative = nodes
+    n_uncertain = 0
+    for columns, K_columns in column_blocks:
+        diag = K_columns[columns, np.arange(len(columns))]
+        i, j = np.nonzero(K_columns >= diag[np.newaxis, :])
+        if margin > 0:
+            near = np.abs(K_columns - diag[np.newaxis, :]) <= margin
+            near[columns, np.arange(len(columns))] = False
+            n_uncertain += int(near.sum())
+
+        links = csr_matrix((np.ones(len(i) + n, dtype=bool),
+                            (np.r_[i, nodes], np.r_[columns[j],
+                                                    representative])),
+                           shape=(n, n))
+        _, components = connected_components(links, directed=False)
+        _, first = np.unique(components, return_index=True)
+        representative = first[components]
+
+    _, components = np.unique(representative, return_inverse=True)
+
+    return components.ravel(), n_uncertain
+
+
+def _sparse_metagraph_components(L, tau, method, k, block_size, n_probes,
+                                 seed):
+    """
+    The metagraph components of e^(-tau L) for a sparse Laplacian, and the
+    diagnostics of the approximation.
+    """
+
+    n = L.shape[0]
+    blocks = [np.arange(start, min(start + block_size, n))
+              for start in range(0, n, block_size)]
+    info = {}
+
+    if method == 'spectral':
+        # e^(-tau L) ~ V_k e^(-tau Lambda_k) V_k^T. The omitted part is
+        # positive semi-definite with norm at most e^(-tau lambda_k), which
+        # bounds the error of every entry
+        eigenvalues, V = _smallest_eigenpairs(L, k)
+        weights = np.exp(-tau * eigenvalues)
+        bound = np.exp(-tau * eigenvalues[-1]) if len(eigenvalues) < n \
+            else 0.0
+
+        column_blocks = ((columns, V @ (weights[:, np.newaxis] *
+                                        V[columns].T)) for columns in blocks)
+        components, n_uncertain = _blockwise_components(n, column_blocks,
+                                                        margin=2 * bound)
+
+        info['Z'] = _hutchinson_trace(L, tau, n_probes, seed,
+                                      eigenvalues=eigenvalues, V=V)
+        info['truncation_error'] = bound / info['Z']
+        info['uncertain_comparisons'] = n_uncertain
+        if n_uncertain > 0:
+            warnings.warn("%i comparisons of the metagraph are within the "
+                          "truncation error of the %i smallest eigenpairs; "
+                          "increase k or use method='krylov'"
+                          % (n_uncertain, k))
+
+    elif method == 'krylov':
+        diagonal = np.zeros(n)
+
+        def column_blocks():
+            for columns in blocks:
+                E = np.zeros((n, len(columns)))
+                E[columns, np.arange(len(columns))] = 1.0
+                K_columns = expm_multiply(-tau * L, E)
+                diagonal[columns] = K_columns[columns, np.arange(len(columns))]
+                yield columns, K_columns
+
+        components, _ = _blockwise_components(n, column_blocks())
+        info['Z'] = diagonal.sum()
+
+    else:
+        raise ValueError("method must be 'dense', 'spectral', 'krylov' or "
+                         "'local', not %r" % method)
+
+    return components, info
+
+
+def _locality_radius(tau, max_degree, tol):
+    """
+    The smallest r such that the heat kernel between nodes more than r hops
+    apart is at most tol. e^(-tau L) is the transition matrix of a walker
+    that leaves node i at rate d_i, so reaching a node r+1 hops away takes
+    at least r+1 jumps, which happens with probability at most
+    P(Poisson(tau max_degree) > r).
+    """
+
+    radius = 0
+    while poisson.sf(radius, tau * max_degree) > tol:
+        radius += 1
+
+    return radius
+
+
+def _local_metagraph_components(L, tau, radius=None, tol=None):
+    """
+    The metagraph components of e^(-tau L), comparing each node j only with
+    the nodes of its ball of radius r, found by a bounded BFS. The column j
+    of the heat kernel is computed on the ball alone (with the walker
+    absorbed when it leaves it), which underestimates its entries by at most
+    tol. By Jensen's inequality K_jj >= e^(-tau d_j), so if tol is below
+    e^(-tau max_degree) (the default is a thousandth of it) no link of the
+    metagraph is lost outside the balls.
+    """
+
+    n = L.shape[0]
+    degree = L.diagonal()
+    max_degree = degree.max() if n > 0 else 0.0
+    if tol is None:
+        tol = 1e-3 * np.exp(-tau * max_degree)
+    if radius is None:
+        radius = _locality_radius(tau, max_degree, tol)
+
+    adjacency = csr_matrix(L, copy=True)
+    adjacency.setdiag(0)
+    adjacency.eliminate_zeros()
+
+    in_ball = np.zeros(n, dtype=bool)
+    rows, cols = [], []
+    Z = 0.0
+    for j in range(n):
+        # bounded BFS from j
+        ball = [np.array([j])]
+        frontier = ball[0]
+        in_ball[j] = True
+        for _ in range(radius):
+            reached = np.unique(adjacency[frontier].indices)
+            frontier = reached[~in_ball[reached]]
+            if len(frontier) == 0:
+                break
+            in_ball[frontier] = True
+            ball.append(frontier)
+        ball = np.concatenate(ball)
+        in_ball[ball] = False
+
+        # column j of the heat kernel, restricted to the ball
+        L_ball = L[ball][:, ball]
+        if len(ball) <= 100:
+            K_j = expm(-tau * L_ball.toarray())[:, 0]
+        else:
+            e_j = np.zeros(len(ball))
+            e_j[0] = 1.0
+            K_j = expm_multiply(-tau * L_ball, e_j)
+
+        linked = ball[K_j >= K_j[0]]
+        rows.append(linked)
+        cols.append(np.full(len(linked), j))
+        Z += K_j[0]
+
+    rows, cols = np.concatenate(rows), np.concatenate(cols)
+    links = csr_matrix((np.ones(len(rows), dtype=bool), (rows, cols)),
+                       shape=(n, n))
+    _, components = connected_components(links, directed=False)
+
+    return components, {'Z': Z, 'radius': radius, 'tol': tol}
+
+
+def _macro_graph(G, labels):
+    """
+    Contract the nodes of G that share a label into a single node, in one
+    pass over the edges. Edges inside a supernode are dropped, self-loops are
+    kept, and every edge of the coarse-grained graph has weight 1.0.
+
+    Parameters
+    ----------
+    G (nx.Graph): the micro network, with the nodes in the order of labels.
+    labels (np.ndarray): the label of each node, as given by
+                         _supernode_labels.
+
+    Returns
+    -------
+    G_macro (nx.Graph): the coarse-grained graph.
+    macro_label_dict (dict): the macro node of each micro node.
+
+    """
+
+    nodes = list(G)
+    n = len(nodes)
+    macro_label_dict = {u: (int(labels[i]) if labels[i] >= n else u)
+                        for i, u in enumerate(nodes)}
+
+    # each supernode takes the place (and attributes) of its smallest node
+    G_macro = G.__class__()
+    G_macro.add_nodes_from((macro_label_dict[u], G.nodes[u]) for u in nodes
+                           if macro_label_dict[u] not in G_macro)
+    G_macro.add_edges_from(
+        (macro_label_dict[u], macro_label_dict[v], d)
+        for u, v, d in G.edges(data=True)
+        if u == v or macro_label_dict[u] != macro_label_dict[v])
+    nx.set_edge_attributes(G_macro, 1.0, 'weight')
+
+    return G_macro, macro_label_dict
+
+
+def _mapping_and_edgelist(G_macro, macro_label_dict):
+    """
+    The mapping and weighted edge list returned by laplacian_renormalization.
+    """
+
+    wel = nx.to_pandas_edgelist(G_macro)
+    if 'weight' not in wel.columns:
+        wel['weight'] = 1.0
+    wel = wel[['source','target','weight']].copy()
+    mapping_df = pd.DataFrame({"micro":list(macro_label_dict.keys()),
+                               "macro":list(macro_label_dict.values())})
+
+    return mapping_df, wel
+
+
+def laplacian_renormalization(G, tau, dev=False, method='dense', k=100,
+                              block_size=256, n_probes=32, seed=None,
+                              radius=None, tol=None):
     '''
     Coarsen a networkx graph by collapsing nodes based on a parameter tau.
 
@@ -31,70 +364,292 @@ def laplacian_renormalization(G, tau, dev=False):
         The input graph to be coarsened.
     tau : float
         The parameter used for coarsening.
+    method : str
+        'dense' (default) computes e^(-tau L) with a dense expm. For large
+        sparse graphs, 'spectral' uses only the k smallest eigenpairs of L
+        and 'krylov' computes blocks of columns of e^(-tau L) with
+        expm_multiply. Both stream the metagraph block by block, in
+        O(N block_size) memory. 'local' only compares the nodes within
+        radius hops of each other, computing each column of e^(-tau L) on
+        the ball of its node, so the work scales with the volume of the
+        balls instead of N^2 (cheap for small tau).
+    k : int
+        Number of eigenpairs used by the 'spectral' method. The bound on the
+        error of each entry of rho is reported as 'truncation_error' (see
+        Returns), and a warning is raised if any comparison of the
+        metagraph is within it.
+    block_size : int
+        Number of columns of e^(-tau L) evaluated at once by the sparse
+        methods.
+    n_probes : int
+        Number of Hutchinson probes used to estimate Z(tau) = tr(e^(-tau L))
+        in the 'spectral' method (on top of the exact part of the k
+        eigenpairs). The sparse methods report Z as 'Z'.
+    seed : int
+        Seed of the Hutchinson probes.
+    radius : int
+        Number of hops within which the 'local' method compares nodes. By
+        default, the smallest radius beyond which the heat kernel is below
+        tol, reported with it as 'radius' and 'tol'.
+    tol : float
+        Bound on the heat kernel neglected by the 'local' method. Defaults
+        to 1e-3 e^(-tau max_degree), a thousandth of the smallest possible
+        diagonal entry, so that no link of the metagraph is missed.
 
     Returns:
     -------
     networkx.Graph
-        The coarsened graph.
+        The coarsened graph, if dev is True.
+    (pd.DataFrame, pd.DataFrame)
+        Otherwise, the micro-to-macro mapping and the weighted edge list of
+        the coarsened graph.
 
-    '''
-    # Get the number of nodes in the input graph
-    n = G.number_of_nodes()
+    The diagnostics of the sparse and local methods ('Z',
+    'truncation_error' and 'uncertain_comparisons' for 'spectral', 'Z' for
+    'krylov', 'Z', 'radius' and 'tol' for 'local') are stored in the graph
+    attributes of the coarsened graph, and in the attrs of the mapping.
 
+    '''
     # Calculate the Laplacian matrix of the input graph
     L = nx.laplacian_matrix(G)
-    L1 = L.todense()
-
-    # Compute e^(-tau * L) and normalize it
-    num = expm((-tau * L1))
-    den = np.trace(num)
-    rho = num / den
-
-    # Build the metagraph G1 based on the rho values
-    adj2 = np.zeros((n, n))
-    for i in range(n):
-        for j in range(n):
-            if ((rho[i][j] >= rho[j][j]) or (rho[i][j] >= rho[i][i])):
-                adj2[i][j] = 1
-    G1 = nx.from_numpy_array(adj2)
-    unique_macro_ids = [idx for idx, comp in enumerate(list(nx.connected_components(G)))]
-
-    macro_label_dict = {i:-1 for i in G.nodes()}
-
-    # Contract nodes in the input graph based on connected components in G1
-    for macro_idx, supernode in enumerate(list(nx.connected_components(G1))):
-        nodes = sorted(list(supernode))
-        if len(nodes)>1:
-            macro_idx = macro_idx + n
-            macro_label_dict[nodes[0]] = macro_idx
-            for node in nodes[1:]:
-                G = nx.contracted_nodes(G, nodes[0], node, self_loops=False)
-                macro_label_dict[node] = macro_idx
-        else:
-            macro_label_dict[nodes[0]] = nodes[0]
 
-    macro_nodes_wrong_label = np.unique([i for i,j in
-                                         dict(Counter(list(macro_label_dict.values()))).items()
-                                         if j>1])
-    relabel_macro_nodes = {i:idx+n for idx,i in enumerate(macro_nodes_wrong_label)}
-    for i,j in macro_label_dict.items():
-        if j in list(relabel_macro_nodes.keys()):
-            macro_label_dict[i] = relabel_macro_nodes[j]
+    if method == 'dense':
+        L1 = L.todense()
+
+        # Compute e^(-tau * L) and normalize it
+        num = np.asarray(expm((-tau * L1)))
+        den = np.trace(num)
+        rho = num / den
 
+        # Build the metagraph based on the rho values
+        components = _metagraph_components(rho)
+        info = {}
 
-    G = nx.relabel_nodes(G, macro_label_dict).copy()
-    nx.set_edge_attributes(G, 1.0, 'weight')
+    elif method == 'local':
+        components, info = _local_metagraph_components(
+            csr_matrix(L, dtype=float), tau, radius, tol)
+
+    else:
+        # the normalization by Z does not change the metagraph, so the
+        # components are found from the unnormalized heat kernel
+        components, info = _sparse_metagraph_components(
+            csr_matrix(L, dtype=float), tau, method, k, block_size, n_probes,
+            seed)
 
+    # contract each of the connected components into a supernode
+    labels = _supernode_labels(components)
+    G, macro_label_dict = _macro_graph(G, labels)
+    G.graph.update(info)
 
     if dev:
         return G
 
     else:
-        wel = nx.to_pandas_edgelist(G)
-        if 'weight' not in wel.columns:
-            wel['weight'] = 1.0
-        wel = wel[['source','target','weight']].copy()
-        mapping_df = pd.DataFrame({"micro":list(macro_label_dict.keys()),
-                                   "macro":list(macro_label_dict.values())})
-
+        mapping_df, wel = _mapping_and_edgelist(G, macro_label_dict)
+        mapping_df.attrs.update(info)
         return mapping_df, wel
+
+
+def laplacian_renormalization_sweep(G, taus, dev=False):
+    r"""
+    Run laplacian_renormalization for a whole vector of taus at the cost of a
+    single eigendecomposition. As L is symmetric, L = V \Lambda V^T and
+
+        $ \rho(\tau) = V e^{-\tau \Lambda} V^T / Z(\tau) $,
+        $ Z(\tau) = \sum_k e^{-\tau \lambda_k} $,
+
+    so each tau only costs a matrix product instead of a dense expm. Taus
+    that give the same partition share the same coarse-grained graph.
+
+    Parameters
+    ----------
+    G (nx.Graph): the input graph to be coarsened.
+    taus (list or np.ndarray): the values of tau.
+    dev (bool): if True, the coarse-grained graph of each tau is returned
+                instead of its edge list.
+
+    Returns
+    -------
+    sweep (list): one dictionary per tau, in the order of taus, with
+        - tau (float): the value of tau.
+        - size (int): the number of nodes of the coarse-grained graph.
+        - mapping (pd.DataFrame): the micro-to-macro mapping, as returned
+                                  by laplacian_renormalization.
+        - wel (pd.DataFrame): the weighted edge list of the coarse-grained
+                              graph (or G_macro (nx.Graph) if dev is True).
+
+    """
+
+    L = nx.laplacian_matrix(G).toarray().astype(float)
+    eigenvalues, V = li.eigh(L)
+
+    sweep = []
+    outputs = {}
+    for tau in taus:
+        weights = np.exp(-tau * eigenvalues)
+        rho = (V * (weights / weights.sum())) @ V.T
+
+        labels = _supernode_labels(_metagraph_components(rho))
+        key = labels.tobytes()
+        if key not in outputs:
+            G_macro, macro_label_dict = _macro_graph(G, labels)
+            mapping_df, wel = _mapping_and_edgelist(G_macro, macro_label_dict)
+            outputs[key] = (G_macro, mapping_df, wel)
+
+        G_macro, mapping_df, wel = outputs[key]
+        result = {'tau': tau, 'size': G_macro.number_of_nodes(),
+                  'mapping': mapping_df.copy()}
+        if dev:
+            result['G_macro'] = G_macro.copy()
+        else:
+            result['wel'] = wel.copy()
+        sweep.append(result)
+
+    return sweep
+
+
+def _find(parent, x):
+    # root of x in a union-find forest, halving the path on the way
+    while parent[x] != x:
+        parent[x] = parent[parent[x]]
+        x = parent[x]
+    return x
+
+
+def laplacian_renormalization_dendrogram(G, taus=None, bisection_steps=0):
+    r"""
+    Track the merges of the Laplacian renormalization as tau increases,
+    and return them as a compact dendrogram from which the partition at any
+    tau is read with dendrogram_mapping, without recomputing rho.
+
+    The metagraph is evaluated on a grid of taus (with a single
+    eigendecomposition, as in laplacian_renormalization_sweep) and every
+    supernode found is fed to a union-find. Each union of two different
+    sets is a merge event. With bisection_steps > 0, the tau of each event
+    is refined by bisection between the grid point where it was found and
+    the previous one. Nodes that the metagraph separates again at a larger
+    tau stay merged, so the dendrogram describes the nested envelope of
+    the partitions, which coincides with them whenever they are nested.
+
+    Parameters
+    ----------
+    G (nx.Graph): the input graph to be coarsened.
+    taus (list or np.ndarray): increasing grid of taus. Defaults to 200
+                               values between 1e-2 and 1e4.
+    bisection_steps (int): number of bisection steps used to refine the tau
+                           of each merge event (0 keeps the grid values).
+
+    Returns
+    -------
+    dendrogram (np.ndarray): one row [A, B, tau, size] per merge event,
+                             sorted by tau, in the layout of scipy linkage
+                             matrices: the nodes are the sets 0, ..., N-1,
+                             and the set created by row k is N+k.
+
+    """
+
+    if taus is None:
+        taus = np.logspace(-2, 4, 200)
+    taus = np.sort(np.asarray(taus, dtype=float))
+
+    L = nx.laplacian_matrix(G).toarray().astype(float)
+    eigenvalues, V = li.eigh(L)
+    n = len(eigenvalues)
+
+    components_at = {}
+
+    def components(tau):
+        if tau not in components_at:
+            weights = np.exp(-tau * eigenvalues)
+            rho = (V * (weights / weights.sum())) @ V.T
+            components_at[tau] = _metagraph_components(rho)
+        return components_at[tau]
+
+    def merge_tau(u, v, lo, hi):
+        # bisect (geometrically, unless lo is 0) for the smallest tau at
+        # which u and v share a supernode
+        for _ in range(bisection_steps):
+            mid = np.sqrt(lo * hi) if lo > 0 else hi / 2
+            comp = components(mid)
+            if comp[u] == comp[v]:
+                hi = mid
+            else:
+                lo = mid
+        return hi
+
+    parent = list(range(n))
+    set_of_root = list(range(n))
+    sizes = [1] * n
+    dendrogram = []
+
+    previous = 0.0
+    for tau in taus:
+        comp = components(tau)
+
+        # pairs of nodes in the same supernode but in different sets
+        order = np.argsort(comp, kind='stable')
+        same = comp[order[1:]] == comp[order[:-1]]
+        pairs = [(u, v) for u, v in zip(order[:-1][same], order[1:][same])
+                 if _find(parent, u) != _find(parent, v)]
+
+        events = sorted((merge_tau(u, v, previous, tau), u, v)
+                        for u, v in pairs)
+        for tau_uv, u, v in events:
+            root_u, root_v = _find(parent, u), _find(parent, v)
+            if root_u == root_v:
+                continue
+
+            A, B = set_of_root[root_u], set_of_root[root_v]
+            if sizes[root_u] < sizes[root_v]:
+                root_u, root_v = root_v, root_u
+            parent[root_v] = root_u
+            sizes[root_u] += sizes[root_v]
+            set_of_root[root_u] = n + len(dendrogram)
+            dendrogram.append([min(A, B), max(A, B), tau_uv, sizes[root_u]])
+
+        components_at = {}
+        previous = tau
+
+    return np.array(dendrogram, dtype=float).reshape(-1, 4)
+
+
+def dendrogram_mapping(G, dendrogram, tau):
+    """
+    Read the partition at a given tau from the dendrogram returned by
+    laplacian_renormalization_dendrogram, in time linear in the number of
+    nodes.
+
+    Parameters
+    ----------
+    G (nx.Graph): the graph the dendrogram was computed for.
+    dendrogram (np.ndarray): the merge events [A, B, tau, size].
+    tau (float): the value of tau.
+
+    Returns
+    -------
+    mapping_df (pd.DataFrame): the micro-to-macro mapping, labelled as in
+                               laplacian_renormalization.
+
+    """
+
+    n = G.number_of_nodes()
+    n_events = np.searchsorted(dendrogram[:, 2], tau, side='right')
+
+    # every set points at the set it was merged into
+    parent = np.arange(n + n_events)
+    for k in range(n_events):
+        A, B = int(dendrogram[k, 0]), int(dendrogram[k, 1])
+        parent[A] = parent[B] = n + k
+
+    # the sets are created in increasing order, so each set's root is known
+    # once the roots of the later sets are
+    for x in range(n + n_events - 1, -1, -1):
+        parent[x] = parent[parent[x]]
+
+    labels = _supernode_labels(parent[:n])
+    nodes = list(G)
+    mapping_df = pd.DataFrame({"micro": nodes,
+                               "macro": [int(labels[i]) if labels[i] >= n
+                                         else u for i, u in enumerate(nodes)]})
+
+    return mapping_df